@@ -0,0 +1,186 @@
+"""
+Time split_by_mgrs, zonal_cdl, CleanGeometry.clean_geometries and fiona_merge_sourcecode on synthetic data at
+several scales, appending results to a JSON lines file so runs can be compared:
+
+    python benchmarks/run_benchmarks.py --scales small,medium
+    python benchmarks/run_benchmarks.py --compare
+
+CleanGeometry runs in a child process, as it owns a QgsApplication; it is recorded as skipped where QGIS is not
+importable.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import subprocess
+import multiprocessing
+from datetime import datetime
+
+import click
+
+parent = os.path.dirname(os.path.abspath(__file__))
+proj = os.path.dirname(parent)
+sys.path.append(proj)
+sys.path.append(parent)
+
+from synthetic import make_dataset, SCALES
+from fields.split_mgrs import split_by_mgrs
+from fields.shape_ops import zonal_cdl, fiona_merge_sourcecode
+from fields.vector_io import read_layer, write_layer, concat
+
+RESULTS = os.path.join(parent, 'results.jsonl')
+DATA = os.path.join(parent, 'data')
+
+
+def bench_split(paths, work):
+    out_dir = os.path.join(work, 'split')
+    split_by_mgrs(paths['sources'], paths['tiles'], out_dir)
+
+
+def bench_zonal(paths, work):
+    out_dir = os.path.join(work, 'zonal')
+    os.makedirs(out_dir)
+    zonal_cdl(paths['sources'][0][0], paths['cdl'], os.path.join(out_dir, 'zonal.shp'))
+
+
+def bench_clean(paths, work):
+    out_dir = os.path.join(work, 'clean')
+    os.makedirs(out_dir)
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_clean, args=(paths['albers'], paths['codes'],
+                                                        os.path.join(out_dir, 'clean.shp'), queue))
+    proc.start()
+    proc.join()
+    result = queue.get() if not queue.empty() else {'status': 'failed', 'error': 'exit {}'.format(proc.exitcode)}
+    return result
+
+
+def _clean(files, codes, out_file, queue):
+    try:
+        from fields.pyqgis_processing import CleanGeometry
+    except ImportError as e:
+        queue.put({'status': 'skipped', 'error': str(e)})
+        return
+    start = time.perf_counter()
+    CleanGeometry(files, codes, out_file=out_file).clean_geometries()
+    queue.put({'status': 'ok', 'seconds': time.perf_counter() - start})
+
+
+def merge_inputs(paths, prep):
+    """ one <tile>.shp per tile, the tile's split files together, standing in for cleaned tiles """
+    split = os.path.join(prep, 'split')
+    split_by_mgrs(paths['sources'], paths['tiles'], split)
+    files = []
+    for tile in sorted(os.listdir(split)):
+        tile_dir = os.path.join(split, tile)
+        if not os.path.isdir(tile_dir):
+            continue
+        layers = [read_layer(os.path.join(tile_dir, f), columns=['SOURCECODE'])
+                  for f in sorted(os.listdir(tile_dir)) if f.endswith('.shp')]
+        files.append(write_layer(os.path.join(prep, '{}.shp'.format(tile)), concat(layers), 'Polygon'))
+    return files
+
+
+def bench_merge(paths, work, files):
+    fiona_merge_sourcecode(os.path.join(work, 'merged.shp'), files)
+
+
+# (name, benchmark, setup): setup(paths, prep_dir), if given, runs once per scale outside the timed region and its
+# result is passed to the benchmark
+BENCHMARKS = [('split_by_mgrs', bench_split, None),
+              ('zonal_cdl', bench_zonal, None),
+              ('clean_geometries', bench_clean, None),
+              ('fiona_merge_sourcecode', bench_merge, merge_inputs)]
+
+
+def run(scales, repeat=1, select=None, results=RESULTS, data_dir=DATA, seed=0):
+    commit = _commit()
+    stamp = datetime.now().isoformat(timespec='seconds')
+    records = []
+    for scale in scales:
+        paths = make_dataset(os.path.join(data_dir, scale), scale, seed=seed)
+        for name, func, setup in BENCHMARKS:
+            if select and name not in select:
+                continue
+            args = ()
+            if setup:
+                prep = os.path.join(data_dir, scale, 'prep_{}'.format(name))
+                shutil.rmtree(prep, ignore_errors=True)
+                os.makedirs(prep)
+                args = (setup(paths, prep),)
+            times, status, error = [], 'ok', None
+            for r in range(repeat):
+                work = os.path.join(data_dir, scale, 'work_{}'.format(name))
+                shutil.rmtree(work, ignore_errors=True)
+                os.makedirs(work)
+                start = time.perf_counter()
+                out = func(paths, work, *args)
+                elapsed = time.perf_counter() - start
+                if out and out['status'] != 'ok':
+                    status, error = out['status'], out.get('error')
+                    break
+                times.append(out['seconds'] if out else elapsed)
+
+            rec = {'time': stamp, 'commit': commit, 'scale': scale, 'params': SCALES[scale],
+                   'benchmark': name, 'features': paths['features'], 'vertices': paths['vertices'],
+                   'status': status, 'seconds': min(times) if times else None, 'repeats': len(times)}
+            if error:
+                rec['error'] = error
+            print('{} {} {} {}'.format(scale, name, status, '{:.3f} s'.format(rec['seconds']) if times else ''))
+            records.append(rec)
+
+    with open(results, 'a') as f:
+        for rec in records:
+            f.write(json.dumps(rec) + '\n')
+    return records
+
+
+def compare(results=RESULTS):
+    """ print the latest run of each benchmark and scale against the run before it """
+    if not os.path.exists(results):
+        print('no results in {}'.format(results))
+        return
+    with open(results, 'r') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+
+    runs = {}
+    for r in records:
+        if r['status'] == 'ok':
+            runs.setdefault((r['scale'], r['benchmark']), []).append(r)
+
+    print('{:<8}{:<26}{:>12}{:>12}{:>10}  {}'.format('scale', 'benchmark', 'previous', 'latest', 'ratio', 'commits'))
+    for (scale, name), recs in sorted(runs.items()):
+        latest = recs[-1]
+        prev = recs[-2] if len(recs) > 1 else None
+        print('{:<8}{:<26}{:>12}{:>12.3f}{:>10}  {}'.format(
+            scale, name, '{:.3f}'.format(prev['seconds']) if prev else '-', latest['seconds'],
+            '{:.2f}'.format(latest['seconds'] / prev['seconds']) if prev else '-',
+            '{} -> {}'.format(prev['commit'], latest['commit']) if prev else latest['commit']))
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=proj,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+@click.command()
+@click.option('--scales', default='small', help='comma-separated scales: {}'.format(', '.join(SCALES)))
+@click.option('--repeat', default=1, help='runs per benchmark, the fastest is kept')
+@click.option('--only', default=None, help='comma-separated benchmark names to run')
+@click.option('--results', default=RESULTS, help='JSON lines file results are appended to')
+@click.option('--data-dir', default=DATA, help='where synthetic inputs and outputs are written')
+@click.option('--compare', 'compare_', is_flag=True, help='compare the last two runs instead of running')
+def main(scales, repeat, only, results, data_dir, compare_):
+    if compare_:
+        compare(results)
+        return
+    run(scales.split(','), repeat, only.split(',') if only else None, results, data_dir)
+
+
+if __name__ == '__main__':
+    main()
+# ========================= EOF ====================================================================
@@ -0,0 +1,159 @@
+"""
+Synthetic inputs for the benchmark suite: overlapping field polygons from several priority sources, a matching
+MGRS-like tile grid and a categorical CDL-like raster. Everything is generated from a seed, offline.
+"""
+import os
+from collections import OrderedDict
+
+import fiona
+import numpy as np
+import rasterio
+from pyproj import CRS, Transformer
+from rasterio.transform import from_bounds
+from shapely.geometry import Polygon, box, mapping
+from shapely.ops import transform
+
+AEA = '+proj=aea +lat_0=40 +lon_0=-96 +lat_1=20 +lat_2=60 +x_0=0 +y_0=0 +ellps=GRS80 +towgs84=0,0,0,0,0,0,0 ' \
+      '+units=m +no_defs'
+
+# origin of the synthetic study area in Albers metres, roughly central Montana
+ORIGIN = (-1050000., 1000000.)
+
+CROP_CODES = [1, 21, 23, 24, 36, 37, 41, 43]
+NON_CROP_CODES = [111, 121, 141, 152, 176, 190]
+
+SCALES = {'small': {'fields': 500, 'vertices': 16, 'sources': 2, 'overlap': 0.2, 'tiles': 2},
+          'medium': {'fields': 5000, 'vertices': 32, 'sources': 3, 'overlap': 0.2, 'tiles': 3},
+          'large': {'fields': 25000, 'vertices': 64, 'sources': 4, 'overlap': 0.3, 'tiles': 4}}
+
+
+def synthetic_fields(fields=500, vertices=16, sources=2, overlap=0.2, field_size=400., seed=0):
+    """ field polygons in Albers metres keyed by source code, highest priority first
+
+    Fields are laid on a jittered grid; each source digitizes a random share of them with its own offset and
+    scale, so sources overlap each other, and a fraction of each source is digitized twice, shifted, to give
+    self-overlaps and duplicates.
+    """
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(fields)))
+    spacing = field_size * 1.1
+    centers = [(ORIGIN[0] + (i % side) * spacing, ORIGIN[1] + (i // side) * spacing) for i in range(fields)]
+
+    out = OrderedDict()
+    for s in range(sources):
+        code = 'SRC{}'.format(s)
+        share = 1. / (s + 1)
+        polys = []
+        for cx, cy in centers:
+            if rng.random() > share:
+                continue
+            dx, dy = rng.normal(0, field_size * 0.05, 2)
+            poly = _field(cx + dx, cy + dy, field_size * rng.uniform(0.8, 1.1), vertices, rng)
+            polys.append(poly)
+            if rng.random() < overlap:
+                shift = rng.normal(0, field_size * 0.1, 2)
+                polys.append(_field(cx + dx + shift[0], cy + dy + shift[1], field_size * rng.uniform(0.5, 1.),
+                                    vertices, rng))
+            if rng.random() < overlap / 4.:
+                polys.append(Polygon(list(poly.exterior.coords)[::-1]))
+        out[code] = polys
+    return out
+
+
+def _field(cx, cy, size, vertices, rng):
+    """ a roughly rectangular field whose boundary carries about `vertices` nearly collinear points """
+    half = size / 2.
+    corners = [(cx - half, cy - half), (cx + half, cy - half), (cx + half, cy + half), (cx - half, cy + half)]
+    per_side = max(1, vertices // 4)
+    pts = []
+    for (x0, y0), (x1, y1) in zip(corners, corners[1:] + corners[:1]):
+        for t in np.linspace(0, 1, per_side, endpoint=False):
+            jitter = rng.normal(0, 0.05, 2)
+            pts.append((x0 + (x1 - x0) * t + jitter[0], y0 + (y1 - y0) * t + jitter[1]))
+    return Polygon(pts)
+
+
+def write_fields(polys, out_shp, crs='EPSG:4326', code=None):
+    to_crs = Transformer.from_crs(AEA, crs, always_xy=True).transform if crs != AEA else None
+    schema = {'geometry': 'Polygon', 'properties': OrderedDict([('FID', 'int:9')])}
+    if code:
+        schema['properties']['SOURCECODE'] = 'str'
+    with fiona.open(out_shp, 'w', driver='ESRI Shapefile', crs_wkt=CRS.from_user_input(crs).to_wkt(),
+                    schema=schema) as dst:
+        for i, p in enumerate(polys):
+            geo = transform(to_crs, p) if to_crs else p
+            props = {'FID': i}
+            if code:
+                props['SOURCECODE'] = code
+            dst.write({'type': 'Feature', 'properties': props, 'geometry': mapping(geo)})
+    return out_shp
+
+
+def write_tiles(bounds, n, out_shp, crs='EPSG:4326'):
+    """ n x n grid of tiles over the Albers bounds, named like MGRS tiles """
+    to_crs = Transformer.from_crs(AEA, crs, always_xy=True).transform
+    minx, miny, maxx, maxy = bounds
+    w, h = (maxx - minx) / n, (maxy - miny) / n
+    schema = {'geometry': 'Polygon', 'properties': OrderedDict([('MGRS_TILE', 'str')])}
+    letters = 'ABCDEFGHJKLMNPQRSTUV'
+    with fiona.open(out_shp, 'w', driver='ESRI Shapefile', crs_wkt=CRS.from_user_input(crs).to_wkt(),
+                    schema=schema) as dst:
+        for i in range(n):
+            for j in range(n):
+                tile = box(minx + i * w, miny + j * h, minx + (i + 1) * w, miny + (j + 1) * h)
+                dst.write({'type': 'Feature', 'properties': {'MGRS_TILE': '99X{}{}'.format(letters[i], letters[j])},
+                           'geometry': mapping(transform(to_crs, tile))})
+    return out_shp
+
+
+def write_cdl(bounds, out_tif, res=30., crop_fraction=0.7, seed=0, crs='EPSG:4326'):
+    """ categorical uint8 raster of 30 m blocks, crop classes in `crop_fraction` of the blocks """
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = bounds
+    cols, rows = int(np.ceil((maxx - minx) / res)), int(np.ceil((maxy - miny) / res))
+    block = 10
+    br, bc = rows // block + 1, cols // block + 1
+    crops = rng.choice(CROP_CODES, (br, bc))
+    other = rng.choice(NON_CROP_CODES, (br, bc))
+    blocks = np.where(rng.random((br, bc)) < crop_fraction, crops, other).astype(np.uint8)
+    data = np.kron(blocks, np.ones((block, block), dtype=np.uint8))[:rows, :cols]
+
+    to_crs = Transformer.from_crs(AEA, crs, always_xy=True).transform
+    west, south, east, north = transform(to_crs, box(*bounds)).bounds
+    profile = {'driver': 'GTiff', 'height': rows, 'width': cols, 'count': 1, 'dtype': 'uint8', 'nodata': 0,
+               'crs': crs, 'transform': from_bounds(west, south, east, north, cols, rows), 'compress': 'deflate'}
+    with rasterio.open(out_tif, 'w', **profile) as dst:
+        dst.write(data, 1)
+    return out_tif
+
+
+def make_dataset(out_dir, scale='small', seed=0):
+    """ write one synthetic scale to out_dir, return a dict of the paths the benchmarks need """
+    params = SCALES[scale] if isinstance(scale, str) else scale
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    sources = synthetic_fields(params['fields'], params['vertices'], params['sources'], params['overlap'],
+                               seed=seed)
+    geoms = [p for polys in sources.values() for p in polys]
+    minx = min(p.bounds[0] for p in geoms) - 100.
+    miny = min(p.bounds[1] for p in geoms) - 100.
+    maxx = max(p.bounds[2] for p in geoms) + 100.
+    maxy = max(p.bounds[3] for p in geoms) + 100.
+    bounds = (minx, miny, maxx, maxy)
+
+    paths = {'sources': [], 'albers': [], 'codes': list(sources.keys())}
+    for code, polys in sources.items():
+        paths['sources'].append((write_fields(polys, os.path.join(out_dir, '{}.shp'.format(code))), code))
+        paths['albers'].append(write_fields(polys, os.path.join(out_dir, '{}_aea.shp'.format(code)),
+                                            crs=AEA, code=code))
+    paths['tiles'] = write_tiles(bounds, params['tiles'], os.path.join(out_dir, 'tiles.shp'))
+    paths['cdl'] = write_cdl(bounds, os.path.join(out_dir, 'cdl.tif'), seed=seed)
+    paths['features'] = len(geoms)
+    paths['vertices'] = sum(len(p.exterior.coords) for p in geoms)
+    return paths
+
+
+if __name__ == '__main__':
+    pass
+# ========================= EOF ====================================================================
@@ -0,0 +1,198 @@
+"""
+Catalog of source data per state and source code: path, CRS, layer name, feature and vertex counts, extent and a
+content fingerprint. Metadata is computed once and cached in a JSON file next to the data; an entry is only
+recomputed when the size or modification time of one of its files changes, so planning a national run does not
+rescan multi-GB sources.
+"""
+import os
+import sys
+import json
+import hashlib
+
+import click
+import fiona
+from rtree import index
+from pyproj import CRS, Transformer
+from shapely.geometry import shape
+
+parent = os.path.dirname(__file__)
+sys.path.append(parent)
+from shapefiles import source_paths, shapefiles
+
+DATA_ROOTS = ['/media/research', '/home/dgketchum/data']
+
+SIDECARS = ['.shp', '.shx', '.dbf', '.prj', '.cpg']
+
+CHUNK = 1 << 22
+
+# bytes 1-3 of a .dbf header hold the date it was last written
+DBF_DATE = slice(1, 4)
+
+
+def data_root():
+    """ FIELDS_DATA_ROOT if set, otherwise the first of DATA_ROOTS that exists """
+    root = os.environ.get('FIELDS_DATA_ROOT')
+    if root:
+        return root
+    for root in DATA_ROOTS:
+        if os.path.isdir(root):
+            return root
+    return DATA_ROOTS[0]
+
+
+def dataset_files(path):
+    """ every file that makes up a dataset, the sidecars of a shapefile or the file itself """
+    if path.endswith('.shp'):
+        base = path[:-4]
+        return [base + ext for ext in SIDECARS if os.path.exists(base + ext)]
+    return [path]
+
+
+def file_stats(path):
+    return [(os.path.basename(f), os.path.getsize(f), os.stat(f).st_mtime_ns) for f in dataset_files(path)]
+
+
+def fingerprint(path, memo=None):
+    """ sha1 over the contents of a dataset's files, leaving out the write date in a .dbf header so that
+    rewriting identical data on another day keeps its fingerprint
+
+    With memo, a dict of earlier results keyed by path, the hash is reused while the files' size and
+    modification times are unchanged.
+    """
+    stats = file_stats(path)
+    if memo is not None and path in memo and memo[path]['stats'] == [list(s) for s in stats]:
+        return memo[path]['sha1']
+
+    sha = hashlib.sha1()
+    for f in dataset_files(path):
+        sha.update(os.path.basename(f).encode())
+        with open(f, 'rb') as fp:
+            if f.endswith('.dbf'):
+                header = bytearray(fp.read(DBF_DATE.stop))
+                header[DBF_DATE] = b'\x00' * 3
+                sha.update(bytes(header))
+            for chunk in iter(lambda: fp.read(CHUNK), b''):
+                sha.update(chunk)
+    digest = sha.hexdigest()
+    if memo is not None:
+        memo[path] = {'stats': [list(s) for s in stats], 'sha1': digest}
+    return digest
+
+
+class SourceCatalog:
+
+    def __init__(self, root=None, cache_file=None):
+        self.root = root if root else data_root()
+        self.cache_file = cache_file if cache_file else os.path.join(self.root, 'source_catalog.json')
+        self.entries = {}
+        if os.path.exists(self.cache_file):
+            with open(self.cache_file, 'r') as f:
+                self.entries = json.load(f)
+
+    def path(self, state, code):
+        return os.path.join(self.root, source_paths(state)[code])
+
+    def entry(self, state, code, refresh=False):
+        """ cached metadata for one source, scanning it only if it is new or its files changed """
+        key = '{}_{}'.format(state, code)
+        path = self.path(state, code)
+        if not os.path.exists(path):
+            raise FileNotFoundError('{} not found'.format(path))
+
+        cached = self.entries.get(key)
+        if not refresh and cached and cached['path'] == path and \
+                cached['stats'] == [list(s) for s in file_stats(path)]:
+            return cached
+
+        print('scanning {}'.format(path))
+        vertices = 0
+        with fiona.open(path) as src:
+            crs = src.crs_wkt
+            layer = src.name
+            features = len(src)
+            extent = list(src.bounds)
+            for feat in src:
+                if feat['geometry']:
+                    vertices += _vertex_count(feat['geometry']['coordinates'])
+
+        entry = {'state': state, 'code': code, 'path': path, 'crs': crs, 'layer': layer, 'features': features,
+                 'vertices': vertices, 'extent': extent, 'fingerprint': fingerprint(path),
+                 'stats': [list(s) for s in file_stats(path)]}
+        self.entries[key] = entry
+        self.save()
+        return entry
+
+    def state_entries(self, state, refresh=False):
+        """ entries for each source of a state in priority order, skipping sources not on disk """
+        out = []
+        for code in shapefiles(state):
+            try:
+                out.append(self.entry(state, code, refresh))
+            except FileNotFoundError as e:
+                print(e)
+        return out
+
+    def estimate(self, state):
+        entries = self.state_entries(state)
+        return {'sources': len(entries),
+                'features': sum(e['features'] for e in entries),
+                'vertices': sum(e['vertices'] for e in entries)}
+
+    def tiles_for(self, state, tiles_path):
+        """ MGRS tiles whose bounds intersect the extent of any source of a state """
+        entries = self.state_entries(state)
+        idx = index.Index()
+        names = []
+        with fiona.open(tiles_path) as mgrs:
+            tiles_crs = CRS.from_wkt(mgrs.crs_wkt)
+            for i, tile in enumerate(mgrs):
+                idx.insert(i, shape(tile['geometry']).bounds)
+                names.append(tile['properties']['MGRS_TILE'])
+
+        tiles = set()
+        for e in entries:
+            extent = _transform_bounds(e['extent'], CRS.from_wkt(e['crs']), tiles_crs)
+            tiles.update(names[i] for i in idx.intersection(extent))
+        return sorted(tiles)
+
+    def save(self):
+        tmp = self.cache_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp, self.cache_file)
+
+
+def _vertex_count(coords):
+    if coords and isinstance(coords[0], (float, int)):
+        return 1
+    return sum(_vertex_count(c) for c in coords)
+
+
+def _transform_bounds(bounds, src_crs, dst_crs, densify=21):
+    if src_crs == dst_crs:
+        return tuple(bounds)
+    minx, miny, maxx, maxy = bounds
+    xs, ys = [], []
+    for i in range(densify):
+        t = i / (densify - 1.)
+        xs += [minx + t * (maxx - minx)] * 2 + [minx, maxx]
+        ys += [miny, maxy] + [miny + t * (maxy - miny)] * 2
+    tx, ty = Transformer.from_crs(src_crs, dst_crs, always_xy=True).transform(xs, ys)
+    return min(tx), min(ty), max(tx), max(ty)
+
+
+@click.command()
+@click.argument('states', nargs=-1)
+@click.option('--root', default=None, help='data root, defaults to FIELDS_DATA_ROOT or the first existing root')
+@click.option('--refresh', is_flag=True, help='rescan sources even if their files are unchanged')
+def main(states, root, refresh):
+    catalog = SourceCatalog(root)
+    for state in states:
+        for e in catalog.state_entries(state, refresh):
+            print('{} {} {} features, {} vertices, {}'.format(state, e['code'], e['features'], e['vertices'],
+                                                              e['path']))
+
+
+if __name__ == '__main__':
+    main()
+# ========================= EOF ====================================================================
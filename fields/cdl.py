@@ -16,6 +16,12 @@
 
 import os
 
+import numpy as np
+import rasterio
+
+# lookup table of cdl_crops(), built on first use
+_CROP_LUT = None
+
 
 def cdl_crops():
     return {1: 'Corn',
@@ -385,6 +391,57 @@ def cdl_key():
             255: ''}
 
 
+def cdl_lut(groups=None):
+    """ 256-entry uint8 lookup table from CDL class to output value
+
+    With no groups, classes in cdl_crops() map to 1 and all others to 0. groups maps an output value (1-255) to
+    the CDL classes it collects, e.g. {1: [36, 37], 2: [21, 23, 24]}; classes not listed map to 0.
+    """
+    global _CROP_LUT
+    if groups is None:
+        if _CROP_LUT is None:
+            _CROP_LUT = np.zeros(256, dtype=np.uint8)
+            _CROP_LUT[list(cdl_crops().keys())] = 1
+        return _CROP_LUT.copy()
+
+    lut = np.zeros(256, dtype=np.uint8)
+    for value, classes in groups.items():
+        lut[list(classes)] = value
+    return lut
+
+
+def reclassify_cdl(in_raster, out_raster, lut=None, bitpack=True):
+    """ apply a cdl_lut() to a CDL raster block by block, writing a compact tiled uint8 raster, bit-packed
+    (NBITS=1) when the table is a 0/1 crop mask """
+    lut = cdl_lut() if lut is None else np.asarray(lut, dtype=np.uint8)
+    with rasterio.open(in_raster) as src:
+        profile = src.profile.copy()
+        profile.update(driver='GTiff', dtype='uint8', count=1, nodata=None, compress='deflate', tiled=True,
+                       blockxsize=512, blockysize=512)
+        if bitpack and lut.max() <= 1:
+            profile['nbits'] = 1
+        with rasterio.open(out_raster, 'w', **profile) as dst:
+            for _, window in src.block_windows(1):
+                dst.write(lut[src.read(1, window=window)], 1, window=window)
+    print('wrote {}'.format(out_raster))
+    return out_raster
+
+
+def reclassify_years(cdl_rasters, out_dir, lut=None, bitpack=True):
+    """ reclassify each year of {year: cdl raster} once, skipping masks newer than their CDL raster """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    out = {}
+    for year, in_raster in sorted(cdl_rasters.items()):
+        out_raster = os.path.join(out_dir, 'cdl_mask_{}.tif'.format(year))
+        if os.path.exists(out_raster) and os.path.getmtime(out_raster) >= os.path.getmtime(in_raster):
+            print('{} exists, skipping'.format(out_raster))
+        else:
+            reclassify_cdl(in_raster, out_raster, lut, bitpack)
+        out[year] = out_raster
+    return out
+
+
 if __name__ == '__main__':
     pass
 # ========================= EOF ====================================================================
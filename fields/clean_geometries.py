@@ -16,20 +16,97 @@
 
 import os
 import sys
+import inspect
 
 parent = os.path.dirname(__file__)
 sys.path.append(parent)
 from pyqgis_processing import CleanGeometry
 from shapefiles import shapefiles
+from catalog import data_root
+from metrics import METRICS
+from tile_cache import TileCache
 
 import click
 
+# CleanGeometry arguments that change a cleaned tile, part of its cache key
+CACHE_PARAMS = ['popper_ratio_min', 'min_area', 'v_clean', 'dedupe_grid', 'simplify_tolerance', 'precision']
+
 ERROR_LOG = os.path.abspath(os.path.join(parent, 'error_log.txt'))
 if not os.path.isfile(ERROR_LOG):
     with open(ERROR_LOG, 'w') as write:
         write.write('ERROR LOG\n')
 
 
+def clean_tile(state, split, cleaned, tile, profile_dir=None, cache_dir=None, profile_vertices=False, **kwargs):
+    """ clean the split sources of one tile in the priority order of shapefiles(state), retrying once from the
+    last checkpoint; keyword arguments are passed to CleanGeometry
+
+    With profile_dir, stage profiles are written to <profile_dir>/<tile>.jsonl, with vertex counts if
+    profile_vertices.
+
+    With cache_dir, the output is copied from a TileCache entry when the tile's inputs, priority and parameters
+    match an earlier run, and stored there otherwise.
+    """
+    f = [os.path.join(split, x) for x in os.listdir(split) if x.endswith('.shp')]
+    codes = [os.path.splitext(os.path.basename(x))[0].split('_')[-1] for x in f]
+
+    # sort the codes by priority
+    tup_ = [(f_, c) for f_, c in zip(f, codes)]
+    values = [x for x in shapefiles(state)]
+    sort = {v: i for i, v in enumerate(values)}
+    tup_ = sorted(tup_, key=lambda x: sort[x[1]])
+    order_files, order_codes = [x[0] for x in tup_], [x[1] for x in tup_]
+
+    out_shape = os.path.join(cleaned, '{}.shp'.format(tile))
+    checkpoint = os.path.join(cleaned, 'checkpoint')
+    profile = os.path.join(profile_dir, '{}.jsonl'.format(tile)) if profile_dir else None
+    if not os.path.isdir(cleaned):
+        os.makedirs(cleaned)
+    kwargs.setdefault('v_clean', False)
+    kwargs['profile_vertices'] = profile_vertices
+
+    cache, key = None, None
+    if cache_dir:
+        cache = TileCache(cache_dir)
+        key = cache.key(order_files, order_codes, values, cache_params(kwargs))
+        if cache.get(key, out_shape):
+            print('{} unchanged, copied from cache {}'.format(tile, key))
+            METRICS.inc('tiles', state=state, status='cached')
+            return out_shape
+
+    print('writing', out_shape)
+    # the profile holds this run alone, first attempt and retry, so cost_model.py trains on the latest outcome
+    if profile and os.path.exists(profile):
+        os.remove(profile)
+
+    try:
+        geos = CleanGeometry(order_files, order_codes, out_file=out_shape,
+                             checkpoint_dir=checkpoint, profile_file=profile, **kwargs)
+        geos.clean_geometries()
+    except Exception as e:
+        with open(ERROR_LOG, 'a') as write_file:
+            write_file.write('{} {} {}, retrying from checkpoint\n'.format(state, tile, e))
+        print('{} {} {}, retrying from checkpoint\n'.format(state, tile, e))
+        METRICS.inc('tiles', state=state, status='retried')
+        try:
+            geos = CleanGeometry(order_files, order_codes, out_file=out_shape,
+                                 checkpoint_dir=checkpoint, profile_file=profile, **kwargs)
+            geos.clean_geometries()
+        except Exception:
+            METRICS.inc('tiles', state=state, status='failed')
+            raise
+    METRICS.inc('tiles', state=state, status='ok')
+    if cache:
+        cache.put(key, out_shape)
+    return out_shape
+
+
+def cache_params(kwargs):
+    """ the CACHE_PARAMS values a CleanGeometry would run with, its defaults updated by kwargs """
+    sig = inspect.signature(CleanGeometry.__init__).parameters
+    return {k: kwargs.get(k, sig[k].default) for k in CACHE_PARAMS}
+
+
 @click.command()
 @click.argument('state')
 @click.argument('direct')
@@ -40,42 +117,15 @@ def main(state, direct, overwrite=False):
     if direct != '13TDL':
         return
 
-    root = '/home/dgketchum/data'
-    if not os.path.isdir(root):
-        root = '/media/research'
+    root = data_root()
 
     d = os.path.join(root, 'IrrigationGIS/Montana/statewide_irrigation_dataset/future_work_15FEB2024/MGRS')
 
     split = os.path.join(d, 'split_filtered_aea/{}'.format(direct))
     cleaned = os.path.join(d, 'split_cleaned_aea/{}'.format(direct))
 
-    f = [os.path.join(split, x) for x in os.listdir(split) if x.endswith('.shp')]
-    codes = [x.split('_')[-1].strip('.shp') for x in f]
-
-    # sort the codes by priority
-    tup_ = [(f_, c) for f_, c in zip(f, codes)]
-    values = [x for x in shapefiles(state)]
-    sort = {v: i for i, v in enumerate(values)}
-    tup_ = sorted(tup_, key=lambda x: sort[x[1]])
-    order_files, order_codes = [x[0] for x in tup_], [x[1] for x in tup_]
-
-    out_shape = os.path.join(cleaned, '{}.shp'.format(direct))
-    if not os.path.isdir(cleaned):
-        os.mkdir(cleaned)
-    if not os.path.exists(out_shape):
-        print('writing', out_shape)
-
-        try:
-            geos = CleanGeometry(order_files, order_codes, v_clean=False, out_file=out_shape)
-            geos.clean_geometries()
-        except Exception as e:
-            with open(ERROR_LOG, 'a') as write_file:
-                write_file.write('{} {} {}, retrying with v_clean\n'.format(state, direct, e))
-            print('{} {} {}, retrying with v_clean\n'.format(state, direct, e))
-            geos = CleanGeometry(order_files, order_codes, v_clean=True, out_file=out_shape)
-            geos.clean_geometries()
-    else:
-        print('{} exists, skipping'.format(out_shape))
+    clean_tile(state, split, cleaned, direct, profile_dir=os.path.join(d, 'profiles'),
+               cache_dir=os.path.join(d, 'clean_cache'))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,75 @@
+"""
+GeoParquet read and write so stage outputs can be passed as columnar batches instead of shapefiles: geometry is a
+WKB column described by the 'geo' file metadata, attributes are Arrow-typed columns with full-length names, and
+there is no 2 GB or separate .dbf limit.
+
+vector_io.py reads and writes these files as whole Layers alongside the OGR formats; write_table and
+write_side_table here only lay out the Arrow tables.
+"""
+import os
+import json
+from collections import OrderedDict
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyproj import CRS
+
+GEOMETRY = 'geometry'
+GEO_VERSION = '1.0.0'
+ROW_GROUP = 65536
+
+
+def is_parquet(path):
+    return path.endswith('.parquet')
+
+
+def geo_metadata(crs_wkt=None, geometry_types=None):
+    crs = CRS.from_wkt(crs_wkt).to_json_dict() if crs_wkt else None
+    return {'version': GEO_VERSION, 'primary_column': GEOMETRY,
+            'columns': {GEOMETRY: {'encoding': 'WKB', 'geometry_types': sorted(geometry_types or []),
+                                   'crs': crs}}}
+
+
+def _with_geo(schema, crs_wkt=None, geometry_types=None):
+    meta = dict(schema.metadata or {})
+    meta[b'geo'] = json.dumps(geo_metadata(crs_wkt, geometry_types)).encode()
+    return schema.with_metadata(meta)
+
+
+def table_crs(schema):
+    """ WKT of the primary geometry column's CRS from a table or schema's 'geo' metadata, or None """
+    schema = getattr(schema, 'schema', schema)
+    geo = (schema.metadata or {}).get(b'geo')
+    if not geo:
+        return None
+    geo = json.loads(geo)
+    crs = geo['columns'][geo['primary_column']].get('crs')
+    return CRS.from_json_dict(crs).to_wkt() if crs else None
+
+
+def write_table(path, table, crs_wkt=None, geometry_types=None):
+    """ write a table with a WKB geometry column as GeoParquet, keeping its 'geo' metadata unless crs_wkt is
+    given """
+    if crs_wkt or b'geo' not in (table.schema.metadata or {}):
+        table = table.replace_schema_metadata(_with_geo(table.schema, crs_wkt, geometry_types).metadata)
+    tmp = path + '.tmp'
+    pq.write_table(table, tmp, row_group_size=ROW_GROUP, compression='zstd')
+    os.replace(tmp, path)
+    return path
+
+
+def write_side_table(path, columns):
+    """ write attributes without geometry, {name: array}, as Parquet """
+    d_name = os.path.dirname(path)
+    if d_name and not os.path.isdir(d_name):
+        os.makedirs(d_name, exist_ok=True)
+    tmp = path + '.tmp'
+    pq.write_table(pa.table(OrderedDict((k, pa.array(v)) for k, v in columns.items())), tmp,
+                   row_group_size=ROW_GROUP, compression='zstd')
+    os.replace(tmp, path)
+    return path
+
+
+if __name__ == '__main__':
+    pass
+# ========================= EOF ====================================================================
@@ -0,0 +1,190 @@
+"""
+Predict how long cleaning a tile will take and how likely it is to fail, from the statistics split_by_mgrs writes
+to tile_stats.json, fitted on the stage profiles (profiling.py) of earlier runs.
+
+Runtime is a least-squares fit of log seconds, failure a logistic regression, both on log feature and vertex
+counts, overlap density and invalid rate. schedule() orders tiles longest first, so the slowest tiles do not start
+last, and marks tiles whose failure risk is above a threshold to be cleaned with v_clean from the start.
+
+    python cost_model.py fit model.json --run /work/MT/split/tile_stats.json /work/MT/profiles
+    python cost_model.py plan model.json /work/ID/split/tile_stats.json
+"""
+import os
+import sys
+import json
+
+import click
+import numpy as np
+
+sys.path.append(os.path.dirname(__file__))
+from profiling import read_profiles
+
+PREDICTORS = ['log_features', 'log_vertices', 'overlap_density', 'invalid_rate']
+
+# seconds per vertex and failure probability used before any history exists
+DEFAULT_SECONDS_PER_VERTEX = 2e-3
+DEFAULT_RISK = 0.05
+
+
+def design(stats):
+    """ predictor rows, with an intercept column, for a list of tile statistics """
+    x = np.array([[1.,
+                   np.log1p(s['features']),
+                   np.log1p(s['vertices']),
+                   s['overlap_density'],
+                   s['invalid_rate']] for s in stats], dtype=float)
+    return x.reshape(-1, len(PREDICTORS) + 1)
+
+
+def training_data(runs):
+    """ join tile statistics with profiled outcomes, runs is a list of (tile_stats.json, profile_dir)
+
+    A tile's runtime is the total wall time of its profiled stages; it failed if any stage did. Tiles cleaned with
+    v_clean from the start are left out: the plan sent them there, and their runtime and outcome are those of
+    another cleaning path, so both fits describe the default path the plan decides on.
+    """
+    stats, seconds, failed = [], [], []
+    for stats_file, profile_dir in runs:
+        with open(stats_file, 'r') as f:
+            tile_stats = json.load(f)
+        outcomes = {}
+        for r in read_profiles(profile_dir):
+            o = outcomes.setdefault(r['tile'], {'wall': 0., 'failed': False, 'v_clean': False})
+            o['wall'] += r['wall']
+            o['failed'] |= r['status'] == 'failed'
+            o['v_clean'] |= bool(r.get('v_clean'))
+        for tile, o in outcomes.items():
+            if tile in tile_stats and o['wall'] > 0 and not o['v_clean']:
+                stats.append(tile_stats[tile])
+                seconds.append(o['wall'])
+                failed.append(o['failed'])
+    return stats, np.array(seconds), np.array(failed, dtype=float)
+
+
+class CostModel:
+
+    def __init__(self, runtime_coef=None, risk_coef=None, n=0):
+        self.runtime_coef = np.asarray(runtime_coef) if runtime_coef is not None else None
+        self.risk_coef = np.asarray(risk_coef) if risk_coef is not None else None
+        self.n = n
+
+    def fit(self, stats, seconds, failed, l2=1.0):
+        x = design(stats)
+        self.n = len(x)
+        if self.n < x.shape[1]:
+            print('{} profiled tiles, too few to fit, keeping defaults'.format(self.n))
+            return self
+        self.runtime_coef = np.linalg.lstsq(x, np.log(seconds), rcond=None)[0]
+        if 0 < failed.sum() < len(failed):
+            self.risk_coef = _logistic(x, failed, l2)
+        else:
+            print('no {} in history, keeping the default risk'.format(
+                'failures' if not failed.sum() else 'successes'))
+        return self
+
+    def predict(self, stats):
+        """ predicted seconds and failure probability for each of a list of tile statistics """
+        x = design(stats)
+        if self.runtime_coef is not None:
+            seconds = np.exp(x @ self.runtime_coef)
+        else:
+            seconds = np.array([s['vertices'] for s in stats], dtype=float) * DEFAULT_SECONDS_PER_VERTEX
+        if self.risk_coef is not None:
+            risk = 1. / (1. + np.exp(-(x @ self.risk_coef)))
+        else:
+            risk = np.full(len(x), DEFAULT_RISK)
+        return seconds, risk
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'predictors': PREDICTORS, 'n': self.n,
+                       'runtime_coef': None if self.runtime_coef is None else self.runtime_coef.tolist(),
+                       'risk_coef': None if self.risk_coef is None else self.risk_coef.tolist()}, f, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        if not path or not os.path.exists(path):
+            return cls()
+        with open(path, 'r') as f:
+            d = json.load(f)
+        return cls(d['runtime_coef'], d['risk_coef'], d['n'])
+
+
+def _logistic(x, y, l2=1.0, iterations=50):
+    """ L2-regularized logistic regression by Newton's method on standardized predictors, the intercept
+    unpenalized; returns coefficients for the unstandardized design """
+    mu, sd = x[:, 1:].mean(axis=0), x[:, 1:].std(axis=0)
+    sd[sd == 0] = 1.
+    x = np.column_stack([x[:, 0], (x[:, 1:] - mu) / sd])
+    coef = np.zeros(x.shape[1])
+    penalty = np.full(x.shape[1], l2)
+    penalty[0] = 0.
+    for _ in range(iterations):
+        p = 1. / (1. + np.exp(-(x @ coef)))
+        grad = x.T @ (p - y) + penalty * coef
+        hess = (x * (p * (1. - p))[:, None]).T @ x + np.diag(penalty)
+        step = np.linalg.solve(hess + 1e-9 * np.eye(len(coef)), grad)
+        coef -= step
+        if np.abs(step).max() < 1e-8:
+            break
+    scaled = coef[1:] / sd
+    return np.concatenate([[coef[0] - (mu * scaled).sum()], scaled])
+
+
+def load_tile_stats(stats_file):
+    if not os.path.exists(stats_file):
+        return {}
+    with open(stats_file, 'r') as f:
+        return json.load(f)
+
+
+def plan_for(stats_file, model_file=None, risk_threshold=0.5):
+    """ {tile: (seconds, risk, v_clean)} for the tiles of a split """
+    return {t: (s, r, v) for t, s, r, v in schedule(load_tile_stats(stats_file), CostModel.load(model_file),
+                                                    risk_threshold)}
+
+
+def schedule(tile_stats, model, risk_threshold=0.5):
+    """ [(tile, seconds, risk, v_clean)] for {tile: stats}, longest predicted runtime first """
+    tiles = sorted(tile_stats)
+    if not tiles:
+        return []
+    seconds, risk = model.predict([tile_stats[t] for t in tiles])
+    plan = [(t, float(s), float(r), bool(r >= risk_threshold)) for t, s, r in zip(tiles, seconds, risk)]
+    return sorted(plan, key=lambda x: -x[1])
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command('fit')
+@click.argument('model_file')
+@click.option('--run', 'runs', multiple=True, type=(str, str), help='tile_stats.json and profile directory')
+def fit_cmd(model_file, runs):
+    stats, seconds, failed = training_data(runs)
+    model = CostModel().fit(stats, seconds, failed)
+    if model.runtime_coef is not None:
+        pred, _ = model.predict(stats)
+        err = np.median(np.abs(np.log(pred / seconds)))
+        print('{} tiles, {} failed, median runtime error x{:.2f}'.format(len(stats), int(failed.sum()),
+                                                                          np.exp(err)))
+    model.save(model_file)
+
+
+@cli.command('plan')
+@click.argument('model_file')
+@click.argument('stats_file')
+@click.option('--risk', default=0.5, help='failure probability above which a tile is cleaned with v_clean')
+def plan_cmd(model_file, stats_file, risk):
+    plan = schedule(load_tile_stats(stats_file), CostModel.load(model_file), risk)
+    for tile, seconds, p, v_clean in plan:
+        print('{} {:>10.0f} s {:>6.2f} {}'.format(tile, seconds, p, 'v_clean' if v_clean else ''))
+    print('{} tiles, {:.1f} h predicted, {} to v_clean'.format(len(plan), sum(x[1] for x in plan) / 3600.,
+                                                                sum(x[3] for x in plan)))
+
+
+if __name__ == '__main__':
+    cli()
+# ========================= EOF ====================================================================
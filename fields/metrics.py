@@ -0,0 +1,216 @@
+"""
+Counters and timers shared by the split, zonal filter, merge, cleaning and pipeline code, written in the
+Prometheus text format so a node exporter's textfile collector can scrape a long run.
+
+Metrics are only written when a directory is configured, with configure() or the FIELDS_METRICS_DIR environment
+variable, which worker processes inherit. Each process writes its own fields_<host>_<pid>.prom, rewritten
+atomically every interval seconds and on exit, with a worker label so series from different processes never
+collide.
+
+    METRICS.inc('features_read', n, stage='split')
+    with METRICS.timer('stage', stage='difference'):
+        ...
+    progress = Progress('tiles', total=120)
+    progress.update(done=12, failed=1)
+
+Short-lived pool workers (see pipeline.py) should not write their own files: they call detach() and hand
+snapshot() back to the parent, which add()s it to its registry.
+
+Import it as 'from metrics import METRICS' with this directory on sys.path, as the other modules here do, so a
+process holds a single registry.
+"""
+import os
+import time
+import atexit
+import socket
+import threading
+
+PREFIX = 'fields_'
+ENV = 'FIELDS_METRICS_DIR'
+
+
+class Metrics:
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.out_dir = None
+        self.interval = 15.
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def inc(self, name, value=1, **labels):
+        """ add value to the counter name{labels} """
+        key = (name, _labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """ set the gauge name{labels} """
+        with self.lock:
+            self.gauges[(name, _labels(labels))] = value
+
+    def timer(self, name, **labels):
+        """ context manager adding wall seconds to name_seconds_total and one to name_total """
+        return _Timer(self, name, labels)
+
+    def configure(self, out_dir=None, interval=15.):
+        """ start writing to out_dir, or to FIELDS_METRICS_DIR, every interval seconds """
+        out_dir = out_dir if out_dir else os.environ.get(ENV)
+        if not out_dir or self.out_dir:
+            return
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.interval = interval
+        os.environ[ENV] = out_dir
+        self._start_thread()
+        atexit.register(self.write)
+
+    def detach(self):
+        """ stop writing a file from this process, keeping the counters for snapshot() """
+        self.out_dir = None
+        self._stopped.set()
+
+    def snapshot(self):
+        """ the counters recorded so far, cleared """
+        with self.lock:
+            counters, self.counters = self.counters, {}
+        return counters
+
+    def add(self, counters):
+        """ add counters from another process's snapshot() """
+        with self.lock:
+            for key, v in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + v
+
+    def _start_thread(self):
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _after_fork(self):
+        # a forked worker starts its own series and writer thread; threads do not survive fork
+        self.counters, self.gauges = {}, {}
+        self.lock = threading.Lock()
+        self.started = time.time()
+        if self.out_dir:
+            self._start_thread()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.write()
+
+    @property
+    def worker(self):
+        return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+    def render(self):
+        """ the metrics in the Prometheus text exposition format """
+        with self.lock:
+            counters, gauges = dict(self.counters), dict(self.gauges)
+        uptime = time.time() - self.started
+        gauges[('uptime_seconds', ())] = uptime
+        for (name, labels), v in counters.items():
+            if name.startswith('features_'):
+                gauges[('{}_per_second'.format(name), labels)] = v / uptime
+
+        lines = []
+        for kind, values in [('counter', counters), ('gauge', gauges)]:
+            names = sorted(set(n for n, _ in values))
+            for name in names:
+                full = PREFIX + name + ('_total' if kind == 'counter' and not name.endswith('_total') else '')
+                lines.append('# TYPE {} {}'.format(full, kind))
+                for (n, labels), v in sorted(values.items()):
+                    if n != name:
+                        continue
+                    labels = dict(labels, worker=self.worker)
+                    lines.append('{}{{{}}} {}'.format(full, ','.join('{}="{}"'.format(k, labels[k])
+                                                                     for k in sorted(labels)), v))
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        if not self.out_dir:
+            return
+        # processes on different nodes can share a pid, and may share out_dir
+        path = os.path.join(self.out_dir, '{}{}_{}.prom'.format(PREFIX, socket.gethostname(), os.getpid()))
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+
+class _Timer:
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, *args):
+        self.seconds = time.perf_counter() - self.start
+        self.metrics.inc('{}_seconds'.format(self.name), self.seconds, **self.labels)
+        self.metrics.inc(self.name, 1, status='failed' if exc_type else 'ok', **self.labels)
+
+
+def _labels(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Progress:
+    """ a progress line with rate and ETA for a known number of units, mirrored in unit gauges """
+
+    def __init__(self, unit, total, metrics=None, min_interval=5.):
+        self.unit = unit
+        self.total = total
+        self.metrics = metrics if metrics else METRICS
+        self.min_interval = min_interval
+        self.started = time.time()
+        self.last = 0.
+        self.done = 0
+        self.failed = 0
+
+    def update(self, done=None, failed=None, total=None, force=False):
+        self.done = self.done if done is None else done
+        self.failed = self.failed if failed is None else failed
+        self.total = self.total if total is None else total
+
+        elapsed = time.time() - self.started
+        finished = self.done + self.failed
+        rate = finished / elapsed if elapsed > 0 else 0.
+        eta = (self.total - finished) / rate if rate > 0 else None
+        self.metrics.set('{}_planned'.format(self.unit), self.total)
+        self.metrics.set('{}_done'.format(self.unit), self.done)
+        self.metrics.set('{}_failed'.format(self.unit), self.failed)
+        self.metrics.set('{}_per_second'.format(self.unit), rate)
+        if eta is not None:
+            self.metrics.set('{}_eta_seconds'.format(self.unit), eta)
+
+        now = time.time()
+        if force or now - self.last >= self.min_interval or finished >= self.total:
+            self.last = now
+            print('[{}/{} {}, {} failed] {:.2f} {}/min, elapsed {}, ETA {}'.format(
+                finished, self.total, self.unit, self.failed, rate * 60., self.unit, _duration(elapsed),
+                _duration(eta) if eta is not None else '-'))
+
+
+def _duration(seconds):
+    seconds = int(seconds)
+    h, rem = divmod(seconds, 3600)
+    m, s = divmod(rem, 60)
+    return '{}h{:02d}m'.format(h, m) if h else '{}m{:02d}s'.format(m, s)
+
+
+METRICS = Metrics()
+METRICS.configure()
+os.register_at_fork(after_in_child=METRICS._after_fork)
+
+if __name__ == '__main__':
+    pass
+# ========================= EOF ====================================================================
@@ -0,0 +1,353 @@
+"""
+Run split -> zonal filter -> project -> clean -> geographic -> merge for a state as a graph of per-tile tasks.
+
+A task is skipped when its outputs exist and the content hash of its inputs, together with its parameters,
+matches the last successful run, so editing one tile rebuilds only the tasks downstream of it. Tasks whose
+dependencies are complete run in parallel, each in a fresh worker process (CleanGeometry owns a QgsApplication).
+
+    python pipeline.py MT /path/to/MGRS_TILE.shp /path/to/work --cdl /path/to/cdl.tif --workers 4
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import subprocess
+import multiprocessing
+
+import click
+
+parent = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(parent)
+sys.path.append(os.path.dirname(parent))
+
+from catalog import SourceCatalog, fingerprint, dataset_files
+from shapefiles import shapefiles
+from split_mgrs import split_by_mgrs, ATTRIBUTES
+from shape_ops import zonal_cdl, fiona_merge_sourcecode
+from columnar import is_parquet
+from vector_io import convert
+from metrics import METRICS, Progress
+from cost_model import plan_for
+
+# CleanGeometry arguments that change how a tile is cleaned but not the result, left out of task signatures
+RUNTIME_PARAMS = ['memory_budget', 'profile_vertices']
+
+AEA = '+proj=aea +lat_0=40 +lon_0=-96 +lat_1=20 +lat_2=60 +x_0=0 +y_0=0 +ellps=GRS80 +towgs84=0,0,0,0,0,0,0 ' \
+      '+units=m +no_defs'
+
+
+class Task:
+
+    def __init__(self, name, func, args=(), kwargs=None, inputs=(), outputs=(), params=None, deps=(), expand=None,
+                 priority=0.):
+        """ func(*args, **kwargs) must be a module-level function so it can be sent to a worker; expand, if
+        given, is called in the parent once the task is done or skipped and returns further tasks; ready tasks
+        start in order of descending priority """
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs if kwargs else {}
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params if params else {}
+        self.deps = list(deps)
+        self.expand = expand
+        self.priority = priority
+
+
+class Pipeline:
+
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.tasks = {}
+        self.state = {'tasks': {}, 'hashes': {}}
+        if os.path.exists(state_file):
+            with open(state_file, 'r') as f:
+                self.state = json.load(f)
+
+    def add(self, task):
+        self.tasks[task.name] = task
+
+    def signature(self, task):
+        """ hash of the task's function, parameters and the content of its inputs """
+        sha = hashlib.sha1()
+        sha.update('{}.{}'.format(task.func.__module__, task.func.__name__).encode())
+        sha.update(json.dumps(task.params, sort_keys=True, default=str).encode())
+        for path in task.inputs:
+            sha.update(path.encode())
+            sha.update(fingerprint(path, self.state['hashes']).encode())
+        return sha.hexdigest()
+
+    def up_to_date(self, task, signature):
+        last = self.state['tasks'].get(task.name)
+        return last == signature and all(os.path.exists(p) for p in task.outputs)
+
+    def run(self, workers=1):
+        pool = multiprocessing.Pool(workers, maxtasksperchild=1, initializer=METRICS.detach)
+        pending, running, done, failed = dict(self.tasks), {}, set(), set()
+        ran, skipped = 0, 0
+        progress = Progress('tasks', len(self.tasks))
+        try:
+            while pending or running:
+                for name, task in sorted(pending.items(), key=lambda x: -x[1].priority):
+                    if any(d in failed for d in task.deps):
+                        print('{} not run, a dependency failed'.format(name))
+                        failed.add(name)
+                        del pending[name]
+                    elif all(d in done for d in task.deps):
+                        del pending[name]
+                        sig = self.signature(task)
+                        if self.up_to_date(task, sig):
+                            skipped += 1
+                            done.add(name)
+                            METRICS.inc('tasks', status='skipped', kind=_kind(name))
+                            self._expand(task, pending)
+                        else:
+                            print('running {}'.format(name))
+                            running[name] = (sig, pool.apply_async(_call, (task.func, task.args, task.kwargs)))
+
+                for name, (sig, result) in list(running.items()):
+                    if not result.ready():
+                        continue
+                    del running[name]
+                    try:
+                        _, error, counters = result.get()
+                        METRICS.add(counters)
+                        if error:
+                            raise error
+                    except Exception as e:
+                        print('{} failed: {}'.format(name, e))
+                        failed.add(name)
+                        self.state['tasks'].pop(name, None)
+                        METRICS.inc('tasks', status='failed', kind=_kind(name))
+                    else:
+                        ran += 1
+                        done.add(name)
+                        self.state['tasks'][name] = sig
+                        METRICS.inc('tasks', status='ok', kind=_kind(name))
+                        self._expand(self.tasks[name], pending)
+                    self.save()
+                    progress.update(len(done), len(failed), len(self.tasks))
+
+                if running:
+                    time.sleep(0.2)
+        finally:
+            pool.close()
+            pool.join()
+            self.save()
+
+        print('{} tasks run, {} up to date, {} failed'.format(ran, skipped, len(failed)))
+        return failed
+
+    def _expand(self, task, pending):
+        if task.expand:
+            for t in task.expand():
+                self.add(t)
+                pending[t.name] = t
+
+    def save(self):
+        tmp = self.state_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.state_file)
+
+
+def _kind(name):
+    return name.split(':')[0]
+
+
+def _call(func, args, kwargs):
+    """ run a task in a pool worker, returning its result or error with the counters it recorded; the parent
+    adds those to its own metrics, as a worker lives for one task and would otherwise leave a file behind """
+    try:
+        return func(*args, **kwargs), None, METRICS.snapshot()
+    except Exception as e:
+        return None, e, METRICS.snapshot()
+
+
+def project(in_file, out_file, s_srs, t_srs):
+    """ reproject with ogr2ogr, as the to_projected.sh and to_geographic.sh scripts do; GeoParquet inputs and
+    outputs go through a shapefile next to out_file, so any GDAL build will do """
+    d_name = os.path.dirname(out_file)
+    if not os.path.isdir(d_name):
+        os.makedirs(d_name)
+    base = os.path.splitext(out_file)[0]
+    src, dst = in_file, out_file
+    if is_parquet(in_file):
+        src = convert(in_file, base + '_in.shp')
+    if is_parquet(out_file):
+        dst = base + '_out.shp'
+    subprocess.check_call(['ogr2ogr', '-overwrite', '-f', 'ESRI Shapefile', '-s_srs', s_srs, '-t_srs', t_srs,
+                           dst, src])
+    if dst != out_file:
+        convert(dst, out_file)
+    for tmp in {src, dst} - {in_file, out_file}:
+        [os.remove(f) for f in dataset_files(tmp)]
+    return out_file
+
+
+def clean(state, split, cleaned, tile, profile_dir, kwargs, cache_dir=None):
+    from clean_geometries import clean_tile
+    return clean_tile(state, split, cleaned, tile, profile_dir, cache_dir, **kwargs)
+
+
+def zonal(in_shp, in_raster, out_shp, select_codes=None):
+    d_name = os.path.dirname(out_shp)
+    if not os.path.isdir(d_name):
+        os.makedirs(d_name)
+    return zonal_cdl(in_shp, in_raster, out_shp, select_codes=select_codes)
+
+
+def pipeline_dirs(work_dir):
+    return {k: os.path.join(work_dir, k) for k in ['split', 'filtered', 'filtered_aea', 'cleaned_aea', 'cleaned',
+                                                   'profiles', 'clean_cache']}
+
+
+def tile_tasks(state, tile, dirs, cdl=None, clean_kwargs=None, deps=(), ext='.shp', plan=None):
+    """ zonal filter and projection of each split file of a tile, then its cleaning and back-projection
+
+    Split, filtered and geographic files are written with ext, '.shp' or '.parquet'; the projected files
+    CleanGeometry reads and writes are always shapefiles. plan, a (seconds, risk, v_clean) prediction from
+    cost_model.py, sets the tasks' priority and whether cleaning starts with v_clean.
+    """
+    clean_kwargs = dict(clean_kwargs) if clean_kwargs else {}
+    priority = 0.
+    if plan:
+        priority = plan[0]
+        if plan[2]:
+            print('{} predicted failure risk {:.2f}, cleaning with v_clean'.format(tile, plan[1]))
+            clean_kwargs['v_clean'] = True
+    tile_dir = os.path.join(dirs['split'], tile)
+    tasks, projected = [], []
+    for f in sorted(x for x in os.listdir(tile_dir) if x.endswith(ext)):
+        src = os.path.join(tile_dir, f)
+        file_deps = list(deps)
+        if cdl:
+            filtered = os.path.join(dirs['filtered'], tile, f)
+            tasks.append(Task('zonal:{}'.format(f), zonal, (src, cdl, filtered), inputs=[src, cdl],
+                              outputs=[filtered], deps=file_deps, priority=priority))
+            src, file_deps = filtered, ['zonal:{}'.format(f)]
+        aea = os.path.join(dirs['filtered_aea'], tile, os.path.splitext(f)[0] + '.shp')
+        tasks.append(Task('project:{}'.format(os.path.basename(aea)), project, (src, aea, 'EPSG:4326', AEA),
+                          inputs=[src], outputs=[aea], deps=file_deps, priority=priority))
+        projected.append(aea)
+
+    cleaned = os.path.join(dirs['cleaned_aea'], tile, '{}.shp'.format(tile))
+    tasks.append(Task('clean:{}'.format(tile), clean,
+                      (state, os.path.join(dirs['filtered_aea'], tile),
+                       os.path.join(dirs['cleaned_aea'], tile), tile, dirs['profiles'], clean_kwargs,
+                       dirs['clean_cache']),
+                      inputs=projected, outputs=[cleaned],
+                      params={k: v for k, v in clean_kwargs.items() if k not in RUNTIME_PARAMS},
+                      deps=['project:{}'.format(os.path.basename(p)) for p in projected], priority=priority))
+    geo = os.path.join(dirs['cleaned'], '{}{}'.format(tile, ext))
+    tasks.append(Task('geographic:{}'.format(tile), project, (cleaned, geo, AEA, 'EPSG:4326'),
+                      inputs=[cleaned], outputs=[geo], deps=['clean:{}'.format(tile)], priority=priority))
+    return tasks
+
+
+def split_tiles(dirs):
+    if not os.path.isdir(dirs['split']):
+        return []
+    return sorted(t for t in os.listdir(dirs['split'])
+                  if os.path.isdir(os.path.join(dirs['split'], t)) and t != ATTRIBUTES)
+
+
+def state_sources(state, root=None):
+    catalog = SourceCatalog(root)
+    shapes = [(catalog.path(state, c), c) for c in shapefiles(state)]
+    return [(p, c) for p, c in shapes if os.path.exists(p)]
+
+
+def split_task(state, tiles_path, dirs, halo=None, root=None, expand=None, ext='.shp', repair=False,
+               attributes=False):
+    shapes = state_sources(state, root)
+    kwargs = {'halo': halo, 'ext': ext, 'repair': repair, 'attributes': attributes}
+    return Task('split', split_by_mgrs, (shapes, tiles_path, dirs['split']), kwargs,
+                inputs=[p for p, _ in shapes] + [tiles_path], outputs=[dirs['split']],
+                params=dict(kwargs, codes=[c for _, c in shapes]), expand=expand)
+
+
+def merge_task(state, out_shp, geographic, halo=None, deps=(), attributes_dir=None):
+    """ merge of the geographic tiles, joining source attributes from the side tables in attributes_dir """
+    tables = []
+    if attributes_dir and os.path.isdir(attributes_dir):
+        tables = [os.path.join(attributes_dir, f) for f in sorted(os.listdir(attributes_dir))
+                  if f.endswith('.parquet')]
+    return Task('merge', fiona_merge_sourcecode, (out_shp, geographic),
+                {'stitch': bool(halo), 'priority': shapefiles(state), 'attributes_dir': attributes_dir},
+                inputs=geographic + tables, outputs=[out_shp],
+                params={'stitch': bool(halo), 'attributes': bool(attributes_dir)}, deps=deps)
+
+
+def attributes_dir(dirs, attributes):
+    return os.path.join(dirs['split'], ATTRIBUTES) if attributes else None
+
+
+def state_pipeline(state, tiles_path, work_dir, cdl=None, halo=None, root=None, clean_kwargs=None, ext='.shp',
+                   repair=False, cost_model=None, risk=0.5, cache_dir=None, attributes=False):
+    """ build the task graph for one state; per-tile tasks are added once the split has run, ordered and given
+    v_clean by the cost model's predictions from the split's tile statistics; with attributes, the merged output
+    has the source attributes of each field """
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    pipe = Pipeline(os.path.join(work_dir, 'pipeline_state.json'))
+    dirs = pipeline_dirs(work_dir)
+    if cache_dir:
+        dirs['clean_cache'] = cache_dir
+    out_shp = os.path.join(work_dir, '{}_fields{}'.format(state, ext))
+
+    def expand_tiles():
+        tasks = []
+        tiles = split_tiles(dirs)
+        plan = plan_for(os.path.join(dirs['split'], 'tile_stats.json'), cost_model, risk)
+        for tile in tiles:
+            tasks += tile_tasks(state, tile, dirs, cdl, clean_kwargs, deps=['split'], ext=ext, plan=plan.get(tile))
+        geographic = [os.path.join(dirs['cleaned'], '{}{}'.format(t, ext)) for t in tiles]
+        tasks.append(merge_task(state, out_shp, geographic, halo, deps=['geographic:{}'.format(t) for t in tiles],
+                                attributes_dir=attributes_dir(dirs, attributes)))
+        return tasks
+
+    pipe.add(split_task(state, tiles_path, dirs, halo, root, expand=expand_tiles, ext=ext, repair=repair,
+                        attributes=attributes))
+    return pipe
+
+
+@click.command()
+@click.argument('state')
+@click.argument('tiles_path')
+@click.argument('work_dir')
+@click.option('--cdl', default=None, help='CDL raster for the zonal crop filter, skipped if not given')
+@click.option('--halo', default=None, type=float, help='halo distance for split tiles, enables seam stitching')
+@click.option('--root', default=None, help='data root for the source catalog')
+@click.option('--workers', default=1, help='parallel worker processes')
+@click.option('--format', 'fmt', default='shp', type=click.Choice(['shp', 'parquet']),
+              help='format of split, filtered, geographic and merged files')
+@click.option('--repair', is_flag=True, help='repair invalid geometries in the split instead of dropping them')
+@click.option('--metrics-dir', default=None, help='directory for Prometheus textfile metrics')
+@click.option('--cost-model', default=None, help='model from cost_model.py fit, to order tiles and pick v_clean')
+@click.option('--risk', default=0.5, help='predicted failure risk above which a tile is cleaned with v_clean')
+@click.option('--cache-dir', default=None, help='cleaned tile cache, shared across runs; defaults to the work dir')
+@click.option('--precision', default=None, type=float,
+              help='fixed-precision grid for cleaning overlays in projected units, e.g. 0.01 for 1 cm')
+@click.option('--memory-budget', default=None, type=float,
+              help='megabytes of geometry above which cleaning keeps intermediate layers on disk')
+@click.option('--attributes', is_flag=True, help='join the source attributes of each field onto the merged output')
+@click.option('--profile-vertices', is_flag=True,
+              help='add vertex counts to the stage profiles, at the cost of a pass over each layer per stage')
+def main(state, tiles_path, work_dir, cdl, halo, root, workers, fmt, repair, metrics_dir, cost_model, risk,
+         cache_dir, precision, memory_budget, attributes, profile_vertices):
+    METRICS.configure(metrics_dir)
+    clean_kwargs = {k: v for k, v in [('precision', precision), ('memory_budget', memory_budget),
+                                      ('profile_vertices', profile_vertices)] if v}
+    pipe = state_pipeline(state, tiles_path, work_dir, cdl, halo, root, clean_kwargs, ext='.{}'.format(fmt),
+                          repair=repair, cost_model=cost_model, risk=risk, cache_dir=cache_dir,
+                          attributes=attributes)
+    failed = pipe.run(workers)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
+# ========================= EOF ====================================================================
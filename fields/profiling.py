@@ -0,0 +1,114 @@
+import os
+import json
+import time
+import resource
+from glob import glob
+from statistics import mean, median
+
+import click
+
+
+class StageProfiler:
+    """ write one JSON line per stage and source layer of a tile: wall and CPU time, peak RSS, feature and
+    vertex counts in and out, and whether the tile was cleaned with v_clean from the start """
+
+    def __init__(self, out_file, tile=None, v_clean=False):
+        self.out = out_file
+        self.tile = tile if tile else os.path.splitext(os.path.basename(out_file))[0]
+        self.v_clean = v_clean
+        d_name = os.path.dirname(out_file)
+        if d_name and not os.path.isdir(d_name):
+            os.makedirs(d_name)
+        self._open = None
+
+    def start(self, stage, source, layer, features, vertices):
+        self._open = {'tile': self.tile, 'stage': stage, 'source': source, 'layer': layer,
+                      'v_clean': self.v_clean, 'in_features': features, 'in_vertices': vertices,
+                      'start': time.time(), '_wall': time.perf_counter(), '_cpu': time.process_time()}
+
+    def stop(self, features, vertices, error=None):
+        rec, self._open = self._open, None
+        if rec is None:
+            return
+        rec['wall'] = time.perf_counter() - rec.pop('_wall')
+        rec['cpu'] = time.process_time() - rec.pop('_cpu')
+        rec['peak_rss_mb'] = peak_rss_mb()
+        rec['out_features'] = features
+        rec['out_vertices'] = vertices
+        rec['status'] = 'failed' if error else 'ok'
+        if error:
+            rec['error'] = str(error)
+        with open(self.out, 'a') as f:
+            f.write(json.dumps(rec) + '\n')
+        return rec
+
+
+def peak_rss_mb():
+    """ peak resident set size of this process so far, in MB (ru_maxrss is KB on Linux, bytes on macOS) """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if os.uname().sysname == 'Darwin':
+        return rss / 1024. ** 2
+    return rss / 1024.
+
+
+def read_profiles(profile_dir):
+    records = []
+    for f in sorted(glob(os.path.join(profile_dir, '*.jsonl'))):
+        with open(f, 'r') as fp:
+            records += [json.loads(line) for line in fp if line.strip()]
+    return records
+
+
+def summarize_profiles(profile_dir, top=10):
+    """ aggregate stage profiles across a state run, print per-stage totals and the slowest tile stages """
+    records = read_profiles(profile_dir)
+    if not records:
+        print('no profiles in {}'.format(profile_dir))
+        return None
+
+    stages = {}
+    for r in records:
+        stages.setdefault(r['stage'], []).append(r)
+
+    summary = {}
+    for stage, recs in stages.items():
+        wall = sorted(r['wall'] for r in recs)
+        feats = sum(r['in_features'] or 0 for r in recs)
+        summary[stage] = {'count': len(recs),
+                          'failed': len([r for r in recs if r['status'] == 'failed']),
+                          'wall_total': sum(wall),
+                          'wall_mean': mean(wall),
+                          'wall_median': median(wall),
+                          'wall_p95': wall[int(0.95 * (len(wall) - 1))],
+                          'wall_max': wall[-1],
+                          'cpu_total': sum(r['cpu'] for r in recs),
+                          'peak_rss_mb': max(r['peak_rss_mb'] for r in recs),
+                          'features_per_sec': feats / sum(wall) if sum(wall) > 0 else None}
+
+    tiles = len(set(r['tile'] for r in records))
+    print('{} records, {} tiles in {}'.format(len(records), tiles, profile_dir))
+    print('{:<20}{:>8}{:>8}{:>12}{:>10}{:>10}{:>10}{:>10}'.format('stage', 'count', 'failed', 'wall_total',
+                                                                   'mean', 'p95', 'max', 'rss_mb'))
+    for stage, s in sorted(summary.items(), key=lambda x: -x[1]['wall_total']):
+        print('{:<20}{:>8}{:>8}{:>12.1f}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.0f}'.format(
+            stage, s['count'], s['failed'], s['wall_total'], s['wall_mean'], s['wall_p95'], s['wall_max'],
+            s['peak_rss_mb']))
+
+    print('\nslowest tile stages')
+    for r in sorted(records, key=lambda x: -x['wall'])[:top]:
+        vertices = ', {} vertices'.format(r['in_vertices']) if r.get('in_vertices') is not None else ''
+        print('{} {} {} {:.1f} s, {} features{} in'.format(r['tile'], r['stage'], r['source'], r['wall'],
+                                                           r['in_features'], vertices))
+    return summary
+
+
+@click.command()
+@click.argument('profile_dir')
+@click.option('--top', default=10, help='number of slowest tile stages to list')
+def main(profile_dir, top):
+    summarize_profiles(profile_dir, top)
+
+
+if __name__ == '__main__':
+    main()
+# ========================= EOF ====================================================================
@@ -23,57 +23,141 @@ Clean vector geometries according to data source priority, return single shapefi
     - project layer to EPSG 102008, NA Albers Equal Area Conic:
         +proj=aea +lat_1=20 +lat_2=60 +lat_0=40 +lon_0=-96 +x_0=0 +y_0=0 +ellps=GRS80 +datum=NAD83 +units=m +no_defs 
         
+    - optionally reduce vertices within a tolerance, keeping shared boundaries coincident
     - remove duplicate geometries from priority layers
-    - remove self-overlaps from priority layers
+    - remove self-overlaps from priority layers, larger features keep contested area
     - remove slivers from self-overlap elimination
     - remove duplicate geometries from added layers
-    - remove self-overlaps from added layers
+    - remove self-overlaps from added layers, larger features keep contested area
     - clip away existing geometries from added layer, DIFFERENCE
     - identify slivers where $area/($perimeter^2) < 0.01
     - eliminate sliver geometries, merging with greatest shared perimeter, maintain original SOURCECODE
     - add non-intersecting geometries where $area > 2023.5 sq m (0.5 acres)
+    - drop HALO features, those loaded from neighboring tiles only as context
     
 The environment requires access to the conda install of QGIS 3:
     
-    'conda create -n qs python=3.7'
+    'conda create -n qs python=3.8'
     'conda install -c conda-forge qgis'
    
 """
 
 import sys
 import os
+import json
+import shutil
+import struct
+import hashlib
+import tempfile
 
 PATHS = [
     '/home/dgketchum/miniconda3/envs/qs/share/qgis/python',
     '/home/dgketchum/miniconda3/envs/qs/share/qgis/python/plugins', ]
 
 [sys.path.insert(0, x) for x in PATHS]
+sys.path.append(os.path.dirname(__file__))
 
 from qgis.core import *
 from qgis.PyQt.QtCore import QVariant
 from qgis.analysis import QgsNativeAlgorithms
 from qgis.core import (QgsVectorLayer,
                        QgsApplication,
+                       QgsCoordinateTransform,
+                       QgsFeature,
                        QgsField,
+                       QgsGeometry,
+                       QgsPointXY,
                        QgsProject,
+                       QgsSpatialIndex,
                        QgsExpression,
                        QgsExpressionContext,
                        QgsExpressionContextUtils,
                        QgsFeatureRequest,
-                       QgsProcessingFeedback,
                        QgsVectorLayer,
-                       QgsProcessingException,
-                       edit)
+                       QgsProcessingException)
 
 import processing
 from processing.core import *
 from processing.core.Processing import Processing
-from processing.tools import dataobjects
+
+from profiling import StageProfiler
+from catalog import fingerprint
+from metrics import METRICS
+from simplify import simplify_shared
+
+BATCH_SIZE = 10000
+
+# first QGIS release whose overlays take a grid size, QgsGeometryParameters and the GRID_SIZE parameter of
+# qgis:difference; older releases run them in floating precision and snap their results to the grid instead
+GRID_SIZE_QGIS = 32800
+
+# source attributes kept through cleaning, everything else is dropped on load; SRC_KEY is the split's key into
+# the source attribute tables the merge joins back
+CARRY_FIELDS = ['HALO', 'SRC_KEY']
+
+
+def normalized_wkb(polygons, grid=None):
+    """ little-endian MultiPolygon WKB of a geometry given as [[ring, ...], ...] of (x, y) tuples
+
+    Coordinates are snapped to grid, shells are wound clockwise and holes counter-clockwise, each ring starts
+    at its lowest vertex, and holes and parts are sorted, so the same shape digitized twice gives the same bytes.
+    """
+    parts = []
+    for polygon in polygons:
+        rings = [_normalized_ring(r, grid, shell=(i == 0)) for i, r in enumerate(polygon)]
+        rings = [r for r in rings if len(r) > 3]
+        if rings:
+            parts.append([rings[0]] + sorted(rings[1:]))
+    parts.sort()
+
+    wkb = [struct.pack('<BII', 1, 6, len(parts))]
+    for rings in parts:
+        wkb.append(struct.pack('<BII', 1, 3, len(rings)))
+        for ring in rings:
+            wkb.append(struct.pack('<I', len(ring)))
+            wkb.append(struct.pack('<{}d'.format(2 * len(ring)), *[c for pt in ring for c in pt]))
+    return b''.join(wkb)
+
+
+def _normalized_ring(ring, grid=None, shell=True):
+    if grid:
+        ring = [(round(x / grid) * grid, round(y / grid) * grid) for x, y in ring]
+    else:
+        ring = [(x, y) for x, y in ring]
+
+    pts = []
+    for pt in ring:
+        if not pts or pt != pts[-1]:
+            pts.append(pt)
+    if len(pts) > 1 and pts[0] == pts[-1]:
+        pts.pop()
+    if len(pts) < 3:
+        return []
+
+    area = sum(x0 * y1 - x1 * y0 for (x0, y0), (x1, y1) in zip(pts, pts[1:] + pts[:1]))
+    if (area > 0) == shell:
+        pts.reverse()
+    start = pts.index(min(pts))
+    pts = pts[start:] + pts[:start]
+    return pts + pts[:1]
 
 
 class CleanGeometry:
 
-    def __init__(self, files, codes, popper_ratio_min=0.05, min_area=2025., v_clean=False, out_file=None):
+    def __init__(self, files, codes, popper_ratio_min=0.05, min_area=2025., v_clean=False, out_file=None,
+                 dedupe_grid=0.01, checkpoint_dir=None, profile_file=None, profile_vertices=False,
+                 simplify_tolerance=None, precision=None, memory_budget=None):
+        """ precision, if given, is a grid size in the units of the layers' CRS (e.g. 0.01 for 1 cm in Albers):
+        vertices are snapped to it on load, and the difference, overlap and elimination overlays run with it as
+        their fixed precision, so nearly coincident boundaries from different sources cannot make them fail; before
+        QGIS 3.28 the overlays run in floating precision and their results are snapped to the grid
+
+        memory_budget, if given, is in megabytes of geometry: a loaded source, the output of the difference, or
+        base, that would hold more is kept in an indexed GeoPackage in a scratch directory instead of in memory,
+        and deleted once the next stage has consumed it
+
+        profile_vertices adds vertex counts to the stage profile; it is off by default, as counting walks every
+        geometry of the layer before and after each stage """
         super(CleanGeometry, self).__init__()
         self.ratio = popper_ratio_min
         self.area = min_area
@@ -81,13 +165,45 @@ class CleanGeometry:
         self.files = files
         self.codes = codes
         self.v_clean = v_clean
+        self.dedupe_grid = dedupe_grid
+        self.simplify_tolerance = simplify_tolerance
+        self.precision = precision
+        self.duplicates = {}
+
+        self.memory_budget = memory_budget
+        # running estimates of the geometry held by working and base, in megabytes, from file sizes
+        self.working_mb = 0.
+        self.base_mb = 0.
+        self.scratch_dir = None
+        self.spill_id = 0
+        if memory_budget is not None:
+            if checkpoint_dir:
+                self.scratch_dir = os.path.join(checkpoint_dir, 'scratch')
+                # intermediates of an earlier attempt, a retry resumes from the checkpoints
+                shutil.rmtree(self.scratch_dir, ignore_errors=True)
+                os.makedirs(self.scratch_dir)
+            else:
+                self.scratch_dir = tempfile.mkdtemp(prefix='clean_')
 
         self.base = None
         self.working = None
         self.code = None
 
-        self.tmp_valid = os.path.join(os.path.dirname(__file__), 'temp_valid.shp')
-        self.tmp_error = os.path.join(os.path.dirname(__file__), 'temp_error.shp')
+        self.checkpoint_dir = checkpoint_dir
+        self.state = {}
+        self.stage = None
+        self.layer_index = None
+        self.retry_layer = None
+
+        self.profiler = StageProfiler(profile_file, v_clean=v_clean) if profile_file else None
+        self.profile_vertices = profile_vertices
+
+        # v.clean and v.buffer outputs, private to this instance so parallel workers never share them
+        if checkpoint_dir and not os.path.isdir(checkpoint_dir):
+            os.makedirs(checkpoint_dir, exist_ok=True)
+        self.tmp_dir = tempfile.mkdtemp(prefix='clean_', dir=checkpoint_dir)
+        self.tmp_valid = os.path.join(self.tmp_dir, 'temp_valid.shp')
+        self.tmp_error = os.path.join(self.tmp_dir, 'temp_error.shp')
 
         self.processing_id = 1
         self.ingest_id = 1
@@ -104,82 +220,276 @@ class CleanGeometry:
         self.project.setCrs(QgsCoordinateReferenceSystem.fromEpsgId(102008))
 
     def clean_geometries(self):
-        first = True
-        for f, c in zip(self.files, self.codes):
+        start, prepared = self._resume()
+        for i, (f, c) in enumerate(zip(self.files, self.codes)):
+            if i < start:
+                continue
             print('processing {}'.format(f))
+            self.layer_index = i
             self.code = c
             if not os.path.exists(f):
                 raise FileNotFoundError('{} not found'.format(f))
-            self._load_layer(f)
-            self._remove_overlaps()
-            self._apply_unique_id()
-            self._to_singlepart()
-
-            if first:
-                self._apply_source_code()
-                self.base = self._get_working()
-                first = False
+
+            if not (i == start and prepared):
+                self._run_stage(self._load_layer, f)
+                if self.simplify_tolerance:
+                    self._run_stage(self._simplify)
+                self._run_stage(self._remove_overlaps)
+                self._run_stage(self._apply_unique_id)
+                self._run_stage(self._to_singlepart)
+                self._run_stage(self._apply_source_code)
+                self._save_checkpoint(i, 'prepared')
+
+            if self.base is None:
+                self._init_base()
             else:
-                self._apply_source_code()
-                self._difference()
-                self._to_singlepart()
-                self._apply_unique_id()
-                self._identify_eliminate()
-                self._eliminate()
-                self._to_singlepart()
-                self._apply_unique_id()
-                self._merge_working_and_layer()
-
-        self._identify_eliminate()
-        self._remove()
+                self._run_stage(self._difference)
+                self._run_stage(self._to_singlepart)
+                self._run_stage(self._apply_unique_id)
+                self._run_stage(self._identify_eliminate)
+                self._run_stage(self._eliminate)
+                self._run_stage(self._to_singlepart)
+                self._run_stage(self._apply_unique_id)
+
+            self._run_stage(self._append_to_base)
+            self._save_checkpoint(i + 1, 'appended')
+
+        self.layer_index = len(self.files)
+        self.working = self.base
+        self._run_stage(self._identify_eliminate)
+        self._run_stage(self._remove)
+        self._run_stage(self._remove_halo)
         self.processing_id = 1
-        self._apply_unique_id()
-        self._write_shapefile()
+        self._run_stage(self._apply_unique_id)
+        self._run_stage(self._write_shapefile)
+        print('duplicates removed by source: {}'.format(self.duplicates))
         print('wrote {}\n'.format(self.out))
+        self.working, self.base = None, None
+        if self.checkpoint_dir:
+            shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+        if self.scratch_dir:
+            shutil.rmtree(self.scratch_dir, ignore_errors=True)
         self.close()
 
+    def _run_stage(self, func, *args):
+        """ run one stage, recording which layer and stage failed so a retry can resume from a checkpoint """
+        self.stage = func.__name__.strip('_')
+        if self.profiler:
+            self.profiler.start(self.stage, self.code, self.layer_index, *self._layer_stats())
+        try:
+            with METRICS.timer('clean_stage', stage=self.stage):
+                result = func(*args)
+        except Exception as e:
+            if self.profiler:
+                self.profiler.stop(*self._layer_stats(), error=e)
+            if self.checkpoint_dir:
+                self.state['failed'] = {'layer': self.layer_index, 'stage': self.stage}
+                self._write_state()
+            raise
+        if self.profiler:
+            self.profiler.stop(*self._layer_stats())
+        if self.stage == 'load_layer':
+            METRICS.inc('features_read', self.working.featureCount(), stage='clean')
+        elif self.stage == 'write_shapefile':
+            METRICS.inc('features_written', self.base.featureCount(), stage='clean')
+        return result
+
+    def _layer_stats(self):
+        """ feature and vertex count of the working layer, or of base between sources """
+        layer = self.working if self.working is not None else self.base
+        if layer is None:
+            return 0, 0
+        vertices = None
+        if self.profile_vertices:
+            request = QgsFeatureRequest().setNoAttributes()
+            vertices = sum([f.geometry().constGet().nCoordinates() for f in layer.getFeatures(request)
+                            if f.hasGeometry()])
+        return layer.featureCount(), vertices
+
+    def _resume(self):
+        """ load the last good checkpoint, returning the layer to start at and whether it is already prepared
+
+        If the failure was in the difference, base is repaired with a negative buffer and the layer resumes
+        from its prepared checkpoint; any other failure reprocesses the failed layer alone with v_clean.
+        """
+        if not self.checkpoint_dir:
+            return 0, False
+        if not os.path.isdir(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+
+        # the content of the inputs, so a checkpoint left by a killed run is not resumed after an input changed
+        fingerprints = [fingerprint(f) for f in self.files]
+        state_file = os.path.join(self.checkpoint_dir, 'state.json')
+        if os.path.exists(state_file):
+            with open(state_file, 'r') as f_:
+                state = json.load(f_)
+            if state['files'] != self.files or state.get('fingerprints') != fingerprints:
+                print('checkpoint in {} is for other inputs, ignoring'.format(self.checkpoint_dir))
+                state = None
+        else:
+            state = None
+
+        if state is None:
+            self.state = {'files': self.files, 'fingerprints': fingerprints, 'layer': 0, 'stage': None,
+                          'processing_id': 1, 'duplicates': {}, 'failed': None}
+            return 0, False
+
+        self.state = state
+        self.processing_id = state['processing_id']
+        self.duplicates = state['duplicates']
+        start, failed = state['layer'], state['failed']
+        if start < len(self.codes):
+            self.layer_index, self.code = start, self.codes[start]
+
+        if start > 0:
+            self._init_base()
+            self._copy_features(self._read_checkpoint('base'), self.base)
+            self.base_mb = self._checkpoint_mb('base')
+
+        prepared = state['stage'] == 'prepared'
+        if failed and failed['layer'] == start:
+            if failed['stage'] == 'difference' and prepared:
+                print('resuming layer {} with repaired base'.format(start))
+                self._repair_base()
+            else:
+                print('resuming layer {} with v_clean'.format(start))
+                self.retry_layer = start
+                prepared = False
+        else:
+            print('resuming at layer {}'.format(start))
+
+        if prepared:
+            layer = self._read_checkpoint('working')
+            self.working = self._new_layer('working', crs=layer.crs(),
+                                           fields=[f for f in layer.fields() if f.name() != 'fid'])
+            self._copy_features(layer, self.working)
+            self.working_mb = self._checkpoint_mb('working')
+        return start, prepared
+
+    def _save_checkpoint(self, layer, stage):
+        if not self.checkpoint_dir:
+            return
+        if stage == 'appended':
+            self._write_checkpoint(self.base, 'base')
+        else:
+            self._write_checkpoint(self.working, 'working')
+        self.state.update({'layer': layer, 'stage': stage, 'processing_id': self.processing_id,
+                           'duplicates': self.duplicates, 'failed': None})
+        self._write_state()
+
+    def _write_checkpoint(self, layer, name):
+        tmp = os.path.join(self.checkpoint_dir, '{}_tmp.gpkg'.format(name))
+        layer.selectAll()
+        processing.run("qgis:saveselectedfeatures", {'INPUT': layer, 'OUTPUT': tmp})
+        layer.removeSelection()
+        os.replace(tmp, os.path.join(self.checkpoint_dir, '{}.gpkg'.format(name)))
+
+    def _read_checkpoint(self, name):
+        return QgsVectorLayer(os.path.join(self.checkpoint_dir, '{}.gpkg'.format(name)), name, 'ogr')
+
+    def _checkpoint_mb(self, name):
+        return os.path.getsize(os.path.join(self.checkpoint_dir, '{}.gpkg'.format(name))) / 1e6
+
+    def _write_state(self):
+        tmp = os.path.join(self.checkpoint_dir, 'state_tmp.json')
+        with open(tmp, 'w') as f_:
+            json.dump(self.state, f_)
+        os.replace(tmp, os.path.join(self.checkpoint_dir, 'state.json'))
+
     def _remove(self):
-        ct = 0
         before = self.working.featureCount()
-        rm_attr = 5 if self.v_clean else 4
-
-        with edit(self.working):
-            for feature in self.working.getFeatures():
-                attrs = feature.attributes()
-                if attrs[rm_attr]:
-                    ct += 1
-                    self.working.deleteFeature(feature.id())
+        rm = [f.id() for f in self.working.getFeatures() if f['eliminate']]
+        ct = len(rm)
+        self.working.dataProvider().deleteFeatures(rm)
         after = self.working.featureCount()
         print(before, 'before', ct, ' deleted', after, 'after')
 
-    def _eliminate(self):
-
-        select = []
-        elim_attr = 5 if self.v_clean else 4
-        for feature in self.working.getFeatures():
-            attrs = feature.attributes()
-            if attrs[elim_attr]:
-                select.append(attrs[0])
+    def _remove_halo(self):
+        """ drop the neighboring-tile features that were only loaded as context """
+        halo = [f.id() for f in self.working.getFeatures() if f['HALO'] == 1]
+        self.working.dataProvider().deleteFeatures(halo)
+        print('{} halo features removed'.format(len(halo)))
 
-        self.working.selectByIds(select, QgsVectorLayer.AddToSelection)
-        params = {'INPUT': self.working,
-                  'MODE': 2,
-                  'OUTPUT': "memory:eliminated"}
-        result = processing.run('qgis:eliminateselectedpolygons', params)
+    def _eliminate(self):
+        """ merge every feature flagged eliminate into the neighbor it shares the longest boundary with, in one
+        batch and in place
+
+        Neighbors come from the provider's spatial index, so the work grows with the number of flagged features
+        rather than with the layer. Each flagged feature is linked to the unflagged neighbor it shares the longest
+        boundary with, or, with none, to its best flagged neighbor, and the links are joined with union-find, so a
+        chain of slivers ends in the unflagged feature that takes the union of the chain and keeps its own
+        attributes, SOURCECODE among them. Flagged features with no unflagged feature anywhere along their chain
+        are left as they are, as qgis:eliminateselectedpolygons leaves them.
+        """
+        flagged = {}
+        request = QgsFeatureRequest().setSubsetOfAttributes(['eliminate'], self.working.fields())
+        for f in self.working.getFeatures(request):
+            if f['eliminate'] and f.hasGeometry():
+                flagged[f.id()] = f.geometry()
+        if not flagged:
+            return
 
-        params = {'LAYERS': result['OUTPUT'],
-                  'CRS': 'EPSG:102008',
-                  'OUTPUT': "memory:merged"}
-        result = processing.run("qgis:mergevectorlayers", params)
-        self.working = result['OUTPUT']
-        self.working.removeSelection()
+        pr = self.working.dataProvider()
+        if pr.hasSpatialIndex() != QgsFeatureSource.SpatialIndexPresent:
+            pr.createSpatialIndex()
+
+        parent = {}
+
+        def find(x):
+            parent.setdefault(x, x)
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        neighbors = {}
+        for fid, geo in flagged.items():
+            boundary = QgsGeometry(geo.constGet().boundary())
+            engine = QgsGeometry.createGeometryEngine(boundary.constGet())
+            engine.prepareGeometry()
+            # unflagged neighbors rank first, so two adjacent slivers never only point at each other
+            best, rank = None, (False, 0.0)
+            near = QgsFeatureRequest().setFilterRect(geo.boundingBox()).setNoAttributes()
+            for n in self.working.getFeatures(near):
+                if n.id() == fid or not n.hasGeometry() or not engine.intersects(n.geometry().constGet()):
+                    continue
+                length = boundary.intersection(n.geometry()).length()
+                if length > 0.0 and (n.id() not in flagged, length) > rank:
+                    best, rank = n, (n.id() not in flagged, length)
+            if best is not None:
+                neighbors[best.id()] = best.geometry()
+                parent[find(fid)] = find(best.id())
+
+        groups = {}
+        for fid in parent:
+            groups.setdefault(find(fid), []).append(fid)
+
+        changes, merged, failed = {}, [], 0
+        for members in groups.values():
+            targets = [m for m in members if m not in flagged]
+            slivers = [m for m in members if m in flagged]
+            if not targets:
+                continue
+            target = targets[0]
+            geo = self._union([neighbors[target]] + [flagged[m] for m in slivers])
+            if geo.isNull() or geo.isEmpty():
+                failed += len(slivers)
+                continue
+            changes[target] = geo
+            merged += slivers
+
+        pr.changeGeometryValues(changes)
+        pr.deleteFeatures(merged)
+        self.working.updateExtents()
+        print('{} flagged: {} merged into {} neighbors, {} with no neighbor to take them, {} failed'.format(
+            len(flagged), len(merged), len(changes), len(flagged) - len(merged) - failed, failed))
 
     def _identify_eliminate(self):
-        pr = self.working.dataProvider()
-        pr.addAttributes([QgsField("sliver", QVariant.Double), QgsField("area", QVariant.Double),
+        self._add_fields([QgsField("sliver", QVariant.Double), QgsField("area", QVariant.Double),
                           QgsField("eliminate", QVariant.Bool)])
 
-        self.working.updateFields()
+        fields = self.working.fields()
+        sliver_idx, area_idx, elim_idx = [fields.indexOf(n) for n in ['sliver', 'area', 'eliminate']]
         expression_1 = QgsExpression('(4 * pi() * area($geometry))/(perimeter($geometry) ^ 2)')
 
         expression_2 = QgsExpression('$area')
@@ -189,139 +499,348 @@ class CleanGeometry:
 
         slivers = 0
         low_area = 0
-        with edit(self.working):
-            ct = 0
-            keep = 0
-            for i, f in enumerate(self.working.getFeatures(), start=self.processing_id):
-                context.setFeature(f)
-                f['sliver'] = expression_1.evaluate(context)
-                f['area'] = expression_2.evaluate(context)
-
-                if f['sliver'] < self.ratio:
-                    f['eliminate'] = True
-                    ct += 1
-                    slivers += 1
-                elif f['area'] < self.area:
-                    f['eliminate'] = True
-                    ct += 1
-                    low_area += 1
-                else:
-                    f['eliminate'] = False
-                    keep += 1
-                self.working.updateFeature(f)
-            try:
-                self.processing_id = i
-            except UnboundLocalError:
-                pass
+        ct = 0
+        keep = 0
+        changes = {}
+        for i, f in enumerate(self.working.getFeatures(), start=self.processing_id):
+            context.setFeature(f)
+            sliver = expression_1.evaluate(context)
+            area = expression_2.evaluate(context)
+
+            if sliver < self.ratio:
+                eliminate = True
+                ct += 1
+                slivers += 1
+            elif area < self.area:
+                eliminate = True
+                ct += 1
+                low_area += 1
+            else:
+                eliminate = False
+                keep += 1
+            changes[f.id()] = {sliver_idx: sliver, area_idx: area, elim_idx: eliminate}
+        try:
+            self.processing_id = i
+        except UnboundLocalError:
+            pass
 
-            print('{} slivers, {} low area'.format(slivers, low_area))
-            print('{} to remove, {} to keep'.format(ct, keep))
+        self.working.dataProvider().changeAttributeValues(changes)
+        print('{} slivers, {} low area'.format(slivers, low_area))
+        print('{} to remove, {} to keep'.format(ct, keep))
 
     def _to_singlepart(self):
-        params = {'INPUT': self.working,
-                  'OUTPUT': 'memory:Single'}
-        result = processing.run('native:multiparttosingleparts', params)
-        self.working = result['OUTPUT']
+        """ explode multipart features in place rather than copying the layer """
+        multi, parts = [], []
+        for f in self.working.getFeatures():
+            geo = f.geometry()
+            # a single polygon in a multi-type geometry is already one part
+            if geo.constGet().partCount() < 2:
+                continue
+            multi.append(f.id())
+            for part in geo.asGeometryCollection():
+                feat = QgsFeature(f)
+                feat.setGeometry(part)
+                parts.append(feat)
+
+        if multi:
+            pr = self.working.dataProvider()
+            pr.deleteFeatures(multi)
+            pr.addFeatures(parts)
+            self.working.updateExtents()
 
     def _difference(self):
         """ the most problematic method, change buffer distance to adjust """
 
         params = {'INPUT': self.working,
                   'OVERLAY': self.base,
-                  'OUTPUT': 'memory:Diff'}
+                  'OUTPUT': self._output('Diff', self.working_mb + self.base_mb)}
+        if self.precision and Qgis.QGIS_VERSION_INT >= GRID_SIZE_QGIS:
+            params['GRID_SIZE'] = self.precision
         try:
             result = processing.run('qgis:difference', params)
-            self.working = result['OUTPUT']
-
+            params = None
+            self._set_working(self._result_layer(result['OUTPUT'], 'Diff'))
         except QgsProcessingException:
-            print('check validity on base {}'.format(self.code))
-            self.base = self._check_validity(self.base)
-            params = {'input': self.base,
-                      'type': 4,
-                      'distance': -0.1,
-                      'layer': -1,
-                      'tolerance': 1.0,
-                      'output': self.tmp_valid}
-            processing.run('grass7:v.buffer', params)
-            self.base = QgsVectorLayer(self.tmp_valid, 'in', 'ogr')
-
-        params = {'INPUT': self.working,
-                  'OVERLAY': self.base,
-                  'OUTPUT': 'memory:Diff'}
-        result = processing.run('qgis:difference', params)
-        self.working = result['OUTPUT']
+            self._repair_base()
+            params['OVERLAY'] = self.base
+            params['OUTPUT'] = self._output('Diff', self.working_mb + self.base_mb)
+            result = processing.run('qgis:difference', params)
+            params = None
+            self._set_working(self._result_layer(result['OUTPUT'], 'Diff'))
+
+        if self.precision and Qgis.QGIS_VERSION_INT < GRID_SIZE_QGIS:
+            self._snap_to_grid(self.working)
+
+    def _repair_base(self):
+        print('check validity on base {}'.format(self.code))
+        # the checked and rebuilt copies of base are as large as base, so they spill like the stage outputs
+        self.base = self._check_validity(self.base, self.base_mb)
+        params = {'input': self.base,
+                  'type': 4,
+                  'distance': -0.1,
+                  'layer': -1,
+                  'tolerance': 1.0,
+                  'output': self.tmp_valid}
+        processing.run('grass7:v.buffer', params)
+        buffered = QgsVectorLayer(self.tmp_valid, 'in', 'ogr')
+        self._init_base(spill=self._over_budget(self.base_mb))
+        self._copy_features(buffered, self.base)
 
     def _write_shapefile(self):
-        self.layer = self._get_working()
-        crs = self.layer.crs()
-        crs.createFromId(102008)
-        self.layer.setCrs(crs)
-        self.layer.selectAll()
+        self.working.selectAll()
         params = {'INPUT': self.working, 'OUTPUT': self.out}
         processing.run("qgis:saveselectedfeatures", params)
         return None
 
-    def _merge_working_and_layer(self):
-        layers = [self.base, self.working]
-        params = {'LAYERS': layers,
-                  'CRS': 'EPSG:102008',
-                  'OUTPUT': "memory:merged"}
-        result = processing.run("qgis:mergevectorlayers", params)
-        self.base = result['OUTPUT']
-        self.working = result['OUTPUT']
+    def _init_base(self, spill=False):
+        """ the single persistent layer that accumulates cleaned features across sources """
+        self.base = self._new_layer('base', 'Polygon', QgsCoordinateReferenceSystem.fromEpsgId(102008),
+                                    [QgsField('id', QVariant.Int),
+                                     QgsField('SOURCECODE', QVariant.String, len=10),
+                                     QgsField('HALO', QVariant.Int),
+                                     QgsField('SRC_KEY', QVariant.LongLong)], spill=spill)
+
+    def _append_to_base(self):
+        self._copy_features(self.working, self.base)
+        self.base_mb += self.working_mb
+        self._set_working(None)
+        self.working_mb = 0.
+        if self.base.providerType() == 'memory' and self._over_budget(self.base_mb):
+            print('base over the memory budget, moving it to scratch')
+            base, self.base = self.base, None
+            self.base = self._spill(base, 'base')
+        print(self.base.featureCount(), ' features in base')
+
+    def _new_layer(self, name, geometry='Polygon', crs=None, fields=None, spill=False):
+        """ an empty layer, in memory or, with spill, in a scratch GeoPackage """
+        crs = crs if crs else self.project.crs()
+        if spill:
+            path = self._scratch_file(name)
+            options = QgsVectorFileWriter.SaveVectorOptions()
+            options.driverName = 'GPKG'
+            options.layerName = name
+            qfields = QgsFields()
+            for f in fields or []:
+                qfields.append(f)
+            writer = QgsVectorFileWriter.create(path, qfields, QgsWkbTypes.parseType(geometry), crs,
+                                                self.project.transformContext(), options)
+            del writer
+            METRICS.inc('clean_spills', stage=self.stage)
+            return QgsVectorLayer(path, name, 'ogr')
+
+        layer = QgsVectorLayer(geometry, name, 'memory')
+        layer.setCrs(crs)
+        if fields:
+            layer.dataProvider().addAttributes(fields)
+            layer.updateFields()
+        return layer
 
-    def _get_working(self):
-        self.working.selectAll()
-        params = {'INPUT': self.working, 'OUTPUT': 'memory:None'}
-        return processing.run("qgis:saveselectedfeatures", params)['OUTPUT']
+    def _over_budget(self, mb):
+        return self.memory_budget is not None and mb > self.memory_budget
+
+    def _scratch_file(self, name):
+        self.spill_id += 1
+        return os.path.join(self.scratch_dir, '{}_{}.gpkg'.format(name, self.spill_id))
+
+    def _output(self, name, mb):
+        """ processing OUTPUT for an intermediate layer, a scratch GeoPackage when its inputs, mb megabytes of
+        geometry, are over the memory budget """
+        if self._over_budget(mb):
+            return self._scratch_file(name)
+        return 'memory:{}'.format(name)
+
+    def _result_layer(self, output, name):
+        """ the layer of a processing OUTPUT, opening it if it was written to scratch """
+        if isinstance(output, str):
+            METRICS.inc('clean_spills', stage=self.stage)
+            return QgsVectorLayer(output, name, 'ogr')
+        return output
+
+    def _spill(self, layer, name):
+        """ copy a layer to a scratch GeoPackage, with a spatial index, and open it """
+        path = self._scratch_file(name)
+        layer.selectAll()
+        processing.run('qgis:saveselectedfeatures', {'INPUT': layer, 'OUTPUT': path})
+        layer.removeSelection()
+        METRICS.inc('clean_spills', stage=self.stage)
+        return QgsVectorLayer(path, name, 'ogr')
+
+    def _set_working(self, layer):
+        """ replace the working layer, releasing the one just consumed and deleting it if it was in scratch """
+        old, self.working = self.working, layer
+        path = old.source().split('|')[0] if old is not None and old.providerType() == 'ogr' else None
+        del old
+        if path and self.scratch_dir and os.path.dirname(path) == self.scratch_dir:
+            for suffix in ['', '-wal', '-shm']:
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+    def _copy_features(self, src, dst, request=None):
+        """ append features of src to dst in batches, matching attributes by field name; a multipart geometry
+        copied to a single-type layer becomes one feature per part """
+        transform = None
+        if src.crs() != dst.crs():
+            transform = QgsCoordinateTransform(src.crs(), dst.crs(), self.project)
+
+        fields = dst.fields()
+        names = [n for n in fields.names()]
+        src_names = src.fields().names()
+        single = not QgsWkbTypes.isMultiType(dst.wkbType())
+        pr = dst.dataProvider()
+        batch = []
+        for f in src.getFeatures(request if request else QgsFeatureRequest()):
+            geo = f.geometry()
+            if transform:
+                geo.transform(transform)
+            # a GeoPackage's fid is assigned on insert
+            attributes = [f[n] if n in src_names and n != 'fid' else None for n in names]
+            parts = geo.asGeometryCollection() if single and geo.isMultipart() else [geo]
+            for part in parts:
+                feat = QgsFeature(fields)
+                feat.setGeometry(part)
+                feat.setAttributes(attributes)
+                batch.append(feat)
+            if len(batch) >= BATCH_SIZE:
+                pr.addFeatures(batch)
+                batch = []
+        if batch:
+            pr.addFeatures(batch)
+        dst.updateExtents()
 
     def _remove_overlaps(self):
+        self._remove_duplicates()
+        self._resolve_overlaps()
+        print(self.working.featureCount(), ' features')
 
-        params = {'INPUT': self.working,
-                  'OUTPUT': 'memory:Union'}
-        context = dataobjects.createContext()
-        context.setInvalidGeometryCheck(QgsFeatureRequest.GeometrySkipInvalid)
-        feedback = QgsProcessingFeedback()
-        result = processing.run('qgis:union', params, context=context, feedback=feedback)
+    def _simplify(self):
+        """ reduce vertices within simplify_tolerance, keeping boundaries shared by neighboring fields coincident
 
-        params = {'INPUT': result['OUTPUT'],
-                  'OUTPUT': 'memory:DeleteDupes'}
-        result = processing.run('qgis:deleteduplicategeometries', params)
+        A feature whose simplified geometry is invalid keeps its original geometry.
+        """
+        features, originals = {}, {}
+        for f in self.working.getFeatures(QgsFeatureRequest().setNoAttributes()):
+            if not f.hasGeometry():
+                continue
+            geo = f.geometry()
+            polygons = geo.asMultiPolygon() if geo.isMultipart() else [geo.asPolygon()]
+            features[f.id()] = [[[(pt.x(), pt.y()) for pt in ring] for ring in poly] for poly in polygons]
+            originals[f.id()] = geo
+
+        simplified = simplify_shared(features, self.simplify_tolerance)
+
+        changes = {}
+        before, after, area_before, area_after, reverted = 0, 0, 0., 0., 0
+        for fid, polygons in simplified.items():
+            geo = originals[fid]
+            n = geo.constGet().nCoordinates()
+            rings = [[[QgsPointXY(x, y) for x, y in ring] for ring in poly] for poly in polygons]
+            new = QgsGeometry.fromPolygonXY(rings[0]) if len(rings) == 1 else QgsGeometry.fromMultiPolygonXY(rings)
+            area_before += geo.area()
+            before += n
+            if new.isGeosValid():
+                changes[fid] = new
+                after += new.constGet().nCoordinates()
+                area_after += new.area()
+            else:
+                reverted += 1
+                after += n
+                area_after += geo.area()
+
+        self.working.dataProvider().changeGeometryValues(changes)
+        print('simplified {}: {} to {} vertices, area change {:.1f} sq m, {} reverted'.format(
+            self.code, before, after, area_after - area_before, reverted))
+
+    def _remove_duplicates(self):
+        """ drop exact and near-exact duplicates in a single pass by hashing normalized geometry WKB """
+        seen = set()
+        dupes = []
+        for f in self.working.getFeatures(QgsFeatureRequest().setNoAttributes()):
+            if not f.hasGeometry():
+                continue
+            geo = f.geometry()
+            polygons = geo.asMultiPolygon() if geo.isMultipart() else [geo.asPolygon()]
+            polygons = [[[(pt.x(), pt.y()) for pt in ring] for ring in poly] for poly in polygons]
+            key = hashlib.sha1(normalized_wkb(polygons, self.dedupe_grid)).digest()
+            if key in seen:
+                dupes.append(f.id())
+            else:
+                seen.add(key)
 
-        self.working = result['OUTPUT']
-        print(self.working.featureCount(), ' features')
+        self.working.dataProvider().deleteFeatures(dupes)
+        self.duplicates[self.code] = self.duplicates.get(self.code, 0) + len(dupes)
+        print('{} duplicates removed from {}'.format(len(dupes), self.code))
 
-    def _apply_unique_id(self):
-        pr = self.working.dataProvider()
-        pr.addAttributes([QgsField("id", QVariant.Int)])
+    def _resolve_overlaps(self):
+        """ give contested area to the larger of each overlapping pair, visiting features by descending area
 
-        self.working.updateFields()
+        Each feature loses only the area already owned by larger features it overlaps, found through a spatial
+        index of the owned geometries, so no fragments are created beyond the difference itself. Ties in area are
+        broken by feature id to keep the result deterministic. Invalid geometries are dropped, as the union
+        overlay previously skipped them.
+        """
+        order, invalid = [], []
+        for f in self.working.getFeatures():
+            geo = f.geometry()
+            if not f.hasGeometry() or not geo.isGeosValid():
+                invalid.append(f.id())
+            else:
+                order.append((-geo.area(), f.id(), geo))
+        order.sort(key=lambda x: (x[0], x[1]))
+
+        index = QgsSpatialIndex()
+        owned = {}
+        changes, empty = {}, []
+        failed = 0
+        for _, fid, geo in order:
+            engine = QgsGeometry.createGeometryEngine(geo.constGet())
+            engine.prepareGeometry()
+            hits = [owned[c] for c in index.intersects(geo.boundingBox())
+                    if engine.intersects(owned[c].constGet()) and not engine.touches(owned[c].constGet())]
+            if hits:
+                diff = self._difference_of(geo, self._union(hits))
+                if diff.isNull():
+                    failed += 1
+                elif diff.isEmpty() or diff.area() == 0.0:
+                    empty.append(fid)
+                    continue
+                else:
+                    geo = diff
+                    changes[fid] = geo
+            owned[fid] = geo
+            index.addFeature(fid, geo.boundingBox())
 
-        context = QgsExpressionContext()
-        context.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(self.working))
+        pr = self.working.dataProvider()
+        pr.changeGeometryValues(changes)
+        pr.deleteFeatures(invalid + empty)
+        self.working.updateExtents()
+        print('{} overlaps clipped, {} contained, {} invalid, {} failed'.format(len(changes), len(empty),
+                                                                           len(invalid), failed))
 
-        with edit(self.working):
-            ct = 0
-            for i, f in enumerate(self.working.getFeatures(), start=self.processing_id):
-                f['id'] = i
-                self.working.updateFeature(f)
-            try:
-                self.processing_id = i
-            except UnboundLocalError:
-                pass
+    def _apply_unique_id(self):
+        self._add_fields([QgsField("id", QVariant.Int)])
+        idx = self.working.fields().indexOf('id')
+
+        changes = {}
+        for i, fid in enumerate(self.working.allFeatureIds(), start=self.processing_id):
+            changes[fid] = {idx: i}
+        try:
+            self.processing_id = i
+        except UnboundLocalError:
+            pass
+        self.working.dataProvider().changeAttributeValues(changes)
+
+    def _add_fields(self, fields):
+        """ add only the fields not already on the working layer """
+        existing = self.working.fields().names()
+        new = [f for f in fields if f.name() not in existing]
+        if new:
+            self.working.dataProvider().addAttributes(new)
+            self.working.updateFields()
 
     def _apply_source_code(self):
-        formula = "'{}'".format(self.code)
-        params = {'INPUT': self.working,
-                  'FIELD_NAME': 'SOURCECODE',
-                  'FIELD_TYPE': 2,
-                  'FIELD_LENGTH': 10,
-                  'FIELD_PRECISION': 0,
-                  'NEW_FIELD': True,
-                  'OUTPUT': 'memory:Sourcecode',
-                  'FORMULA': formula}
-        result = processing.run('qgis:fieldcalculator', params)
-        self.working = result['OUTPUT']
+        self._add_fields([QgsField('SOURCECODE', QVariant.String, len=10)])
+        idx = self.working.fields().indexOf('SOURCECODE')
+        self.working.dataProvider().changeAttributeValues({fid: {idx: self.code} for fid in self.working.allFeatureIds()})
 
     def _strip_fields(self):
         fields = [i for i, x in enumerate(self.working.dataProvider().fields())]
@@ -329,17 +848,72 @@ class CleanGeometry:
         self.working.updateFields()
 
     def _load_layer(self, file_):
+        """ read geometries only into a memory layer, or a scratch GeoPackage if the source is over the memory
+        budget, leaving the source file untouched """
         layer = QgsVectorLayer(file_, 'in', 'ogr')
 
-        self.project.addMapLayer(layer)
-        fields = [i for i, x in enumerate(layer.dataProvider().fields())]
-        layer.dataProvider().deleteAttributes(fields)
-        layer.updateFields()
-
-        if self.v_clean:
-            self.working = self._v_clean(layer, )
-        else:
-            self.working = layer
+        if self.v_clean or self.layer_index == self.retry_layer:
+            layer = self._v_clean(layer, )
+
+        carry = [f for f in layer.fields() if f.name() in CARRY_FIELDS]
+        # the size of a shapefile's .shp is close to that of its geometry as WKB
+        self.working_mb = os.path.getsize(file_) / 1e6
+        self._set_working(self._new_layer('working', crs=layer.crs(), fields=carry,
+                                          spill=self._over_budget(self.working_mb)))
+        request = QgsFeatureRequest().setSubsetOfAttributes([f.name() for f in carry], layer.fields())
+        self._copy_features(layer, self.working, request)
+        if self.precision:
+            self._snap_to_grid(self.working)
+
+    def _snap_to_grid(self, layer):
+        """ snap every vertex to the precision grid in place, repairing the polygons snapping makes invalid and
+        dropping those that collapse """
+        changes, collapsed, repaired = {}, [], 0
+        for f in layer.getFeatures(QgsFeatureRequest().setNoAttributes()):
+            if not f.hasGeometry():
+                continue
+            geo = f.geometry().snappedToGrid(self.precision, self.precision)
+            if not geo.isNull() and not geo.isGeosValid():
+                geo = self._repaired(geo)
+                repaired += 1
+            if geo.isNull() or geo.isEmpty() or geo.area() == 0.0:
+                collapsed.append(f.id())
+            else:
+                changes[f.id()] = geo
+
+        pr = layer.dataProvider()
+        pr.changeGeometryValues(changes)
+        pr.deleteFeatures(collapsed)
+        layer.updateExtents()
+        print('snapped {} features to a {} grid, {} repaired, {} collapsed'.format(len(changes), self.precision,
+                                                                                repaired, len(collapsed)))
+
+    @staticmethod
+    def _repaired(geo):
+        return geo.makeValid().convertToType(QgsWkbTypes.PolygonGeometry, True)
+
+    def _on_grid(self, geo):
+        """ an overlay result snapped to the precision grid, on QGIS releases whose overlays cannot take it """
+        if not self.precision or geo.isNull():
+            return geo
+        geo = geo.snappedToGrid(self.precision, self.precision)
+        return geo if geo.isNull() or geo.isGeosValid() else self._repaired(geo)
+
+    def _geometry_parameters(self):
+        params = QgsGeometryParameters()
+        if self.precision:
+            params.setGridSize(self.precision)
+        return params
+
+    def _union(self, geometries):
+        if Qgis.QGIS_VERSION_INT < GRID_SIZE_QGIS:
+            return self._on_grid(QgsGeometry.unaryUnion(geometries))
+        return QgsGeometry.unaryUnion(geometries, self._geometry_parameters())
+
+    def _difference_of(self, geo, other):
+        if Qgis.QGIS_VERSION_INT < GRID_SIZE_QGIS:
+            return self._on_grid(geo.difference(other))
+        return geo.difference(other, self._geometry_parameters())
 
     def _v_clean(self, layer, min_area=2023.0):
         """
@@ -384,7 +958,8 @@ class CleanGeometry:
         layer = QgsVectorLayer(self.tmp_valid, 'in', 'ogr')
         return layer
 
-    def _check_validity(self, layer):
+    def _check_validity(self, layer, mb=0.):
+        """ the valid features of layer, mb megabytes of geometry, kept in scratch if over the memory budget """
 
         def check_alg(layer):
             params = {'ERROR_OUTPUT': 'memory:Temp',
@@ -392,7 +967,7 @@ class CleanGeometry:
                       'INPUT_LAYER': layer,
                       'INVALID_OUTPUT': 'memory:Temp2',
                       'METHOD': 1,
-                      'VALID_OUTPUT': 'memory:Valid'}
+                      'VALID_OUTPUT': self._output('Valid', mb)}
             result = processing.run('qgis:checkvalidity', params)
             inval_qgis_ = result['INVALID_COUNT']
 
@@ -401,7 +976,7 @@ class CleanGeometry:
                       'INPUT_LAYER': result['VALID_OUTPUT'],
                       'INVALID_OUTPUT': 'memory:Temp2',
                       'METHOD': 2,
-                      'VALID_OUTPUT': 'memory:Valid'}
+                      'VALID_OUTPUT': self._output('Valid', mb)}
             result = processing.run('qgis:checkvalidity', params)
             inval_geos_ = result['INVALID_COUNT']
             total_errors = inval_qgis_ + inval_geos_
@@ -412,7 +987,7 @@ class CleanGeometry:
             print('{} errors'.format(errors))
             layer = self._v_clean(result['VALID_OUTPUT'], 2000.0)
             result, errors = check_alg(layer)
-        return result['VALID_OUTPUT']
+        return self._result_layer(result['VALID_OUTPUT'], 'Valid')
 
     def list_algorithms(self):
         for alg in QgsApplication.processingRegistry().algorithms():
@@ -421,6 +996,7 @@ class CleanGeometry:
         processing.algorithmHelp('grass7:v.buffer')
 
     def close(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
         self.app.exitQgis()
         self.app.exit()
 
@@ -2,7 +2,9 @@ import os
 import sys
 from collections import OrderedDict
 
-import fiona
+import numpy as np
+import pyarrow.parquet as pq
+import shapely
 from rasterstats import zonal_stats
 
 pare = os.path.dirname(__file__)
@@ -11,133 +13,231 @@ sys.path.append(pare)
 
 MGRS_PATH = os.path.abspath(os.path.join(proj, 'mgrs', 'mgrs_shapefile', 'MGRS_TILE.shp'))
 
-from shapely.geometry import shape
+from rtree import index
+from shapely.ops import unary_union
 
 PREREQUISITE_ATTRS = [('SOURCECODE', 'str')]
 REQUIRED_ATTRS = [('OPENET_ID', 'str'), ('MGRS_TILE', 'str')]
 ALL_ATTRS = PREREQUISITE_ATTRS + REQUIRED_ATTRS
 
+# attributes written by the split that later stages carry through unchanged
+CARRY_ATTRS = [('HALO', 'int:1'), ('SRC_KEY', 'int:18')]
+
 from fields.cdl import cdl_crops
+from fields.vector_io import Layer, read_layer, write_layer, layer_fields, concat, polygon_parts
+from metrics import METRICS
 
 states_attribute = ['WY']
 
 
 def zonal_cdl(in_shp, in_raster, out_shp=None,
-              select_codes=None, write_non_crop=False):
-    ct = 1
-    geo = []
-    bad_geo_ct = 0
-    with fiona.open(in_shp) as src:
-        meta = src.meta
-        for feat in src:
-            try:
-                _ = feat['geometry']['type']
-                geo.append(feat)
-            except TypeError:
-                bad_geo_ct += 1
-
-    input_feats = len(geo)
-    temp_file = out_shp.replace('.shp', '_temp.shp')
-    with fiona.open(temp_file, 'w', **meta) as tmp:
-        for feat in geo:
-            tmp.write(feat)
-
-    meta['schema'] = {'type': 'Feature', 'properties': OrderedDict(
-        [('FID', 'int:9'), ('CDL', 'int:9')]), 'geometry': 'Polygon'}
-
-    stats = zonal_stats(temp_file, in_raster, stats=['majority'], nodata=0.0, categorical=False)
+              select_codes=None, write_non_crop=False, mask_raster=None, threshold=0.5):
+    """ keep fields whose majority CDL class is a crop, or with mask_raster (see cdl.reclassify_cdl) fields
+    whose mean crop mask is at least threshold """
+    if mask_raster:
+        return _zonal_mask(in_shp, mask_raster, out_shp, threshold, write_non_crop)
+
+    layer = read_layer(in_shp, columns=[k for k, _ in CARRY_ATTRS if k in layer_fields(in_shp)])
+    bad_geo_ct = int(shapely.is_missing(layer.geometry).sum())
+    layer = layer.take(~shapely.is_missing(layer.geometry))
+    input_feats = len(layer)
+
+    stats = zonal_stats(list(layer.geometry), in_raster, stats=['majority'], nodata=0.0, categorical=False)
+    majority = np.array([s['majority'] if s['majority'] is not None else np.nan for s in stats], dtype=float)
+    cdl = np.nan_to_num(majority).astype(int)
 
     if select_codes:
-        include_codes = select_codes
+        include_codes = list(set(select_codes))
+    else:
+        include_codes = list(cdl_crops().keys())
+
+    if write_non_crop:
+        selected = ~np.isin(cdl, include_codes)
     else:
-        include_codes = [k for k in cdl_crops().keys()]
-
-    ct_inval = 0
-    with fiona.open(out_shp, mode='w', **meta) as out:
-        for attr, g in zip(stats, geo):
-            try:
-                cdl = int(attr['majority'])
-            except TypeError:
-                cdl = 0
-
-            if attr['majority'] in include_codes and not write_non_crop:
-                feat = {'type': 'Feature',
-                        'properties': {'FID': ct,
-                                       'CDL': cdl},
-                        'geometry': g['geometry']}
-                if not feat['geometry']:
-                    ct_inval += 1
-                elif not shape(feat['geometry']).is_valid:
-                    ct_inval += 1
-                else:
-                    out.write(feat)
-                    ct += 1
-
-            elif write_non_crop and cdl not in include_codes:
-                feat = {'type': 'Feature',
-                        'properties': {'FID': ct,
-                                       'CDL': cdl},
-                        'geometry': g['geometry']}
-                if not feat['geometry']:
-                    ct_inval += 1
-                elif not shape(feat['geometry']).is_valid:
-                    ct_inval += 1
-                else:
-                    out.write(feat)
-                    ct += 1
-
-        print('{} in, {} out, {} invalid, {}'.format(input_feats, ct - 1, ct_inval, out_shp))
-        d_name = os.path.dirname(out_shp)
-        [os.remove(os.path.join(d_name, x)) for x in os.listdir(d_name) if 'temp' in x]
-
-
-def fiona_merge_sourcecode(out_shp, file_list):
-    meta = fiona.open(file_list[0]).meta
-    meta['schema'] = {'type': 'Feature', 'properties': OrderedDict(
-        [('OBJECTID', 'str'), ('SOURCECODE', 'str'), ('MGRS_TILE', 'str')]),
-                      'geometry': 'Polygon'}
-
-    with fiona.open(out_shp, 'w', **meta) as output:
-        ct = 0
-        none_geo = 0
-        inval_geo = 0
-        for s in file_list:
-            mgrs = s.split('/')[-1].strip('.shp')
-            print(mgrs)
-            for feat in fiona.open(s):
-                if not feat['geometry']:
-                    none_geo += 1
-                elif not shape(feat['geometry']).is_valid:
-                    inval_geo += 1
-                else:
-                    area = shape(feat['geometry']).area
-                    if area == 0.0:
-                        raise AttributeError
-                    ct += 1
-                    source = feat['properties']['SOURCECODE']
-                    feat = {'type': 'Feature', 'properties': OrderedDict(
-                        [('OBJECTID', '{}'.format(ct)), ('SOURCECODE', source),
-                         ('MGRS_TILE', mgrs)]),
-                            'geometry': feat['geometry']}
-                    output.write(feat)
+        selected = np.isin(majority, include_codes)
+    valid = shapely.is_valid(layer.geometry)
+    ct_inval = int((selected & ~valid).sum())
+    keep = selected & valid
+
+    out = layer.take(keep)
+    _write_filtered(out_shp, out, 'CDL', cdl[keep])
+    _count('zonal', input_feats + bad_geo_ct, len(out), bad_geo_ct, ct_inval)
+    print('{} in, {} out, {} invalid, {}'.format(input_feats, len(out), ct_inval, out_shp))
+
+
+def _zonal_mask(in_shp, mask_raster, out_shp, threshold=0.5, write_non_crop=False):
+    layer = read_layer(in_shp, columns=[k for k, _ in CARRY_ATTRS if k in layer_fields(in_shp)])
+    layer = layer.take(~shapely.is_missing(layer.geometry))
+
+    stats = zonal_stats(list(layer.geometry), mask_raster, stats=['mean'])
+    frac = np.array([s['mean'] if s['mean'] is not None else 0. for s in stats], dtype=float)
+
+    selected = (frac >= threshold) != write_non_crop
+    valid = shapely.is_valid(layer.geometry)
+    ct_inval = int((selected & ~valid).sum())
+    keep = selected & valid
+
+    out = layer.take(keep)
+    _write_filtered(out_shp, out, 'CROP_FRAC', frac[keep])
+    _count('zonal', len(layer), len(out), 0, ct_inval)
+    print('{} in, {} out, {} invalid, {}'.format(len(layer), len(out), ct_inval, out_shp))
+
+
+def _count(stage, read, written, none_geo, inval_geo):
+    METRICS.inc('features_read', read, stage=stage)
+    METRICS.inc('features_written', written, stage=stage)
+    METRICS.inc('geometries_none', none_geo, stage=stage)
+    METRICS.inc('geometries_invalid', inval_geo, stage=stage)
+
+
+def _write_filtered(out_shp, layer, name, values):
+    """ write FID, the zonal value and the CARRY_ATTRS layer has """
+    props = OrderedDict([('FID', np.arange(1, len(layer) + 1, dtype=np.int32)), (name, values)])
+    for k, _ in CARRY_ATTRS:
+        if k in layer.columns:
+            props[k] = layer[k]
+    write_layer(out_shp, layer.with_columns(props), 'Polygon')
+
 
+def fiona_merge_sourcecode(out_shp, file_list, stitch=False, priority=None, attributes_dir=None):
+    """ merge cleaned tiles; with stitch, resolve overlaps between features of different tiles along seams
+
+    Stitching gives contested area to the feature whose SOURCECODE comes first in priority (e.g.
+    shapefiles(state)), then to the larger feature, and clips the other. Features from the same tile are
+    never compared, as cleaning already made them disjoint.
+
+    With attributes_dir, the side tables split_by_mgrs(attributes=True) wrote, each feature's source
+    attributes are joined back by SRC_KEY.
+    """
+    layer, none_geo, inval_geo = _read_tiles(file_list)
+    if stitch:
+        return _stitched_merge(out_shp, layer, priority, none_geo, inval_geo, attributes_dir)
+
+    ct = len(layer)
+    out = layer.with_columns(OrderedDict([('OBJECTID', np.arange(1, ct + 1).astype(str).astype(object)),
+                                          ('SOURCECODE', layer['SOURCECODE']),
+                                          ('MGRS_TILE', layer['MGRS_TILE'])] + _key_column(layer)))
+    if attributes_dir:
+        out = join_attributes(out, attributes_dir)
+    write_layer(out_shp, out, 'Polygon')
+    _count('merge', ct + none_geo + inval_geo, ct, none_geo, inval_geo)
     print('wrote {}, {}, {} none, {} invalid'.format(out_shp, ct, none_geo, inval_geo))
 
 
+def _read_tiles(file_list):
+    """ the valid, non-halo features of each tile with SOURCECODE and MGRS_TILE, and the count of missing and
+    invalid geometries """
+    layers, none_geo, inval_geo = [], 0, 0
+    for s in file_list:
+        mgrs = os.path.splitext(os.path.basename(s))[0]
+        print(mgrs)
+        carry = [k for k, _ in CARRY_ATTRS if k in layer_fields(s)]
+        layer = read_layer(s, columns=['SOURCECODE'] + carry)
+        if 'HALO' in layer.columns:
+            layer = layer.take(layer['HALO'] != 1)
+        missing = shapely.is_missing(layer.geometry)
+        valid = shapely.is_valid(layer.geometry)
+        none_geo += int(missing.sum())
+        inval_geo += int((~missing & ~valid).sum())
+        layer = layer.take(valid)
+        if (shapely.area(layer.geometry) == 0.0).any():
+            raise AttributeError
+        layers.append(layer.with_columns(OrderedDict([('SOURCECODE', layer['SOURCECODE']),
+                                                      ('MGRS_TILE', np.full(len(layer), mgrs, dtype=object))]
+                                                     + _key_column(layer))))
+    return concat(layers), none_geo, inval_geo
+
+
+def _key_column(layer, index=slice(None)):
+    return [('SRC_KEY', layer['SRC_KEY'][index])] if 'SRC_KEY' in layer.columns else []
+
+
+def join_attributes(layer, attributes_dir):
+    """ add the source attributes of each feature of layer by its SRC_KEY, from the side tables in
+    attributes_dir; a name the layer already has is not joined """
+    keys = layer['SRC_KEY'].astype(np.int64)
+    joined = OrderedDict()
+    for f in sorted(x for x in os.listdir(attributes_dir) if x.endswith('.parquet')):
+        table = pq.read_table(os.path.join(attributes_dir, f))
+        src_keys = table.column('SRC_KEY').to_numpy()
+        if not len(src_keys):
+            continue
+        # keys are assigned in row order, so each table is sorted by them
+        pos = np.minimum(np.searchsorted(src_keys, keys), len(src_keys) - 1)
+        hit = np.flatnonzero(src_keys[pos] == keys)
+        for name in table.column_names:
+            if name == 'SRC_KEY' or name in layer.columns:
+                continue
+            values = table.column(name).to_numpy(zero_copy_only=False)
+            column = joined.setdefault(name, np.full(len(layer), None, dtype=object))
+            column[hit] = values[pos[hit]]
+    print('joined {} source attributes'.format(len(joined)))
+    return layer.with_columns(OrderedDict(list(layer.columns.items()) +
+                                          [(k, _typed(v)) for k, v in joined.items()]))
+
+
+def _typed(column):
+    """ a joined object column as a numeric array where all its values are numbers, missing values as NaN """
+    present = [v for v in column if v is not None]
+    if present and all(isinstance(v, (int, float, np.integer, np.floating)) and not isinstance(v, bool)
+                       for v in present):
+        if len(present) == len(column):
+            return np.array(list(column))
+        return np.array([np.nan if v is None else v for v in column], dtype=float)
+    return column
+
+
+def _stitched_merge(out_shp, layer, priority=None, none_geo=0, inval_geo=0, attributes_dir=None):
+    rank = {c: i for i, c in enumerate(priority)} if priority else {}
+    ranks = np.array([rank.get(c, len(rank)) for c in layer['SOURCECODE']], dtype=int)
+    order = np.lexsort((np.arange(len(layer)), -shapely.area(layer.geometry), ranks))
+    tiles, sources = layer['MGRS_TILE'], layer['SOURCECODE']
+
+    idx = index.Index()
+    owned = []
+    clipped, dropped = 0, 0
+    for i in order:
+        g, mgrs, source = layer.geometry[i], tiles[i], sources[i]
+        hits = [owned[j][0] for j in idx.intersection(g.bounds)
+                if owned[j][1] != mgrs and g.intersects(owned[j][0]) and not g.touches(owned[j][0])]
+        if hits:
+            g = g.difference(unary_union(hits))
+            clipped += 1
+            if g.is_empty or g.area == 0.0:
+                dropped += 1
+                continue
+        idx.insert(len(owned), g.bounds)
+        owned.append((g, mgrs, source, i))
+
+    parts, part_of = polygon_parts(np.array([o[0] for o in owned], dtype=object))
+    keep = shapely.area(parts) > 0.0
+    parts, part_of = parts[keep], part_of[keep]
+    ct = len(parts)
+    out = Layer(parts, OrderedDict([('OBJECTID', np.arange(1, ct + 1).astype(str).astype(object)),
+                                    ('SOURCECODE', np.array([owned[j][2] for j in part_of], dtype=object)),
+                                    ('MGRS_TILE', np.array([owned[j][1] for j in part_of], dtype=object))]
+                                   + _key_column(layer, np.array([owned[j][3] for j in part_of], dtype=int))),
+                layer.crs)
+    if attributes_dir:
+        out = join_attributes(out, attributes_dir)
+    write_layer(out_shp, out, 'Polygon')
+    _count('merge', len(layer) + none_geo + inval_geo, ct, none_geo, inval_geo)
+    METRICS.inc('seam_clipped', clipped, stage='merge')
+    METRICS.inc('seam_dropped', dropped, stage='merge')
+
+    print('wrote {}, {}, {} none, {} invalid, {} clipped at seams, {} dropped'.format(
+        out_shp, ct, none_geo, inval_geo, clipped, dropped))
+
+
 def check_geometry_fiona(shapefile):
-    ct = 0
-    none_geo = 0
-    inval_geo = 0
-    for feat in fiona.open(shapefile):
-        if not feat['geometry']:
-            none_geo += 1
-        elif not shape(feat['geometry']).is_valid:
-            inval_geo += 1
-        else:
-            area = shape(feat['geometry']).area
-            if area == 0.0:
-                raise AttributeError
-            ct += 1
+    layer = read_layer(shapefile, columns=[])
+    missing = shapely.is_missing(layer.geometry)
+    valid = shapely.is_valid(layer.geometry)
+    if (shapely.area(layer.geometry[valid]) == 0.0).any():
+        raise AttributeError
+    ct = int(valid.sum())
+    none_geo = int(missing.sum())
+    inval_geo = int((~missing & ~valid).sum())
     tot = ct + none_geo + inval_geo
     print('{} valid {}, {} none, {} invalid, {} total'.format(shapefile, ct, none_geo, inval_geo, tot))
 
@@ -1,10 +1,25 @@
 import os
+from collections import OrderedDict
 from pprint import pprint
 
+# source data paths relative to the data root, where they differ from DEFAULT_SOURCE_PATH
+SOURCE_PATHS = {
+    ('MT', 'MTDNRC'): 'IrrigationGIS/Montana/statewide_irrigation_dataset/future_work_15FEB2024/sid/'
+                      'statewide_irrigation_dataset_15FEB2024.shp',
+    ('MT', 'CLU'): 'IrrigationGIS/Montana/statewide_irrigation_dataset/future_work_15FEB2024/clu_wgs/mt.shp',
+}
+
+DEFAULT_SOURCE_PATH = 'IrrigationGIS/fields/sources/{state}/{code}.shp'
+
+
+def source_paths(state):
+    """ relative paths to each source of a state, keyed by source code in priority order """
+    return OrderedDict([(code, SOURCE_PATHS.get((state, code), DEFAULT_SOURCE_PATH.format(state=state, code=code)))
+                        for code in shapefiles(state)])
+
 
 def shapefiles(state):
-    # sort codes in list by priority
-    # TODO: list relative paths to source data in this dict
+    # sort codes in list by priority, see source_paths for their locations
     d = {'AR': ['CLU'],
          'AZ': ['UCRBGS', 'LCRVPD', 'CLU'],
          'CO': ['UCRB', 'CODSS', 'CLU'],
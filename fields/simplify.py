@@ -0,0 +1,118 @@
+"""
+Douglas-Peucker vertex reduction that keeps boundaries shared between neighboring fields identical.
+
+Geometries are given as lists of polygons, each a list of closed rings of (x, y) tuples. Vertices where the set
+of features sharing a boundary changes are pinned, each boundary between pinned vertices is simplified once in
+a canonical direction, and the result is reused by every ring that carries it, so neighbors stay coincident.
+"""
+
+
+def simplify_shared(features, tolerance):
+    """ simplify {key: [polygon, ...]} within tolerance, return {key: [polygon, ...]} of the same structure """
+    owners = {}
+    for key, polygons in features.items():
+        for polygon in polygons:
+            for ring in polygon:
+                for pt in ring[:-1]:
+                    owners.setdefault(pt, set()).add(key)
+
+    fixed = set()
+    for polygons in features.values():
+        for polygon in polygons:
+            for ring in polygon:
+                fixed.update(_junctions(ring[:-1], owners))
+
+    cache = {}
+    out = {}
+    for key, polygons in features.items():
+        out[key] = [[_simplify_ring(ring, fixed, tolerance, cache) for ring in polygon] for polygon in polygons]
+    return out
+
+
+def _junctions(pts, owners):
+    n = len(pts)
+    for i, pt in enumerate(pts):
+        here = owners[pt]
+        if len(here) > 2 or here != owners[pts[i - 1]] or here != owners[pts[(i + 1) % n]]:
+            yield pt
+
+
+def _simplify_ring(ring, fixed, tolerance, cache):
+    pts = ring[:-1]
+    if len(pts) < 4:
+        return ring
+
+    anchors = [i for i, pt in enumerate(pts) if pt in fixed]
+    if not anchors:
+        # an unshared ring, pin its lowest vertex and the vertex farthest from it so both copies of a
+        # duplicated ring pick the same anchors
+        low = pts.index(min(pts))
+        far = max(range(len(pts)), key=lambda i: (_dist2(pts[i], pts[low]), pts[i]))
+        anchors = sorted({low, far})
+    if len(anchors) == 1:
+        anchors.append((anchors[0] + len(pts) // 2) % len(pts))
+        anchors.sort()
+
+    out = []
+    for a, b in zip(anchors, anchors[1:] + anchors[:1]):
+        if b > a:
+            chain = pts[a:b + 1]
+        else:
+            chain = pts[a:] + pts[:b + 1]
+        out.extend(_simplify_chain(chain, tolerance, cache)[:-1])
+
+    if len(out) < 3:
+        return ring
+    return out + out[:1]
+
+
+def _simplify_chain(chain, tolerance, cache):
+    rev = chain[::-1]
+    canonical = min(tuple(chain), tuple(rev))
+    if canonical not in cache:
+        cache[canonical] = douglas_peucker(list(canonical), tolerance)
+    result = cache[canonical]
+    return result if canonical == tuple(chain) else result[::-1]
+
+
+def douglas_peucker(pts, tolerance):
+    if len(pts) < 3:
+        return pts
+    keep = [False] * len(pts)
+    keep[0] = keep[-1] = True
+    tol2 = tolerance ** 2
+    stack = [(0, len(pts) - 1)]
+    while stack:
+        first, last = stack.pop()
+        max_d, index = 0., None
+        for i in range(first + 1, last):
+            d = _segment_dist2(pts[i], pts[first], pts[last])
+            if d > max_d:
+                max_d, index = d, i
+        if index is not None and max_d > tol2:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [pt for pt, k in zip(pts, keep) if k]
+
+
+def _dist2(a, b):
+    return (a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2
+
+
+def _segment_dist2(p, a, b):
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    seg = dx * dx + dy * dy
+    if seg == 0.:
+        return _dist2(p, a)
+    t = max(0., min(1., ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / seg))
+    return _dist2(p, (a[0] + t * dx, a[1] + t * dy))
+
+
+def vertex_count(features):
+    return sum(len(ring) for polygons in features.values() for polygon in polygons for ring in polygon)
+
+
+if __name__ == '__main__':
+    pass
+# ========================= EOF ====================================================================
@@ -1,45 +1,85 @@
 import os
+import sys
+import csv
+import json
 from collections import OrderedDict
 
-import fiona
-from rtree import index
-from shapely.geometry import shape
-
-
-def split_by_mgrs(shapes, tiles_path, out_dir):
-    """attribute source code, split into MGRS tiles"""
-    out_features = []
-    tiles = []
-    idx = index.Index()
-    in_features = []
-    for _file, code in shapes:
-        with fiona.open(_file) as src:
-            print(_file, src.crs)
-            meta = src.meta
-            meta['schema'] = {'type': 'Feature', 'properties': OrderedDict(
-                [('OBJECTID', 'int:9'), ('SOURCECODE', 'str')]), 'geometry': 'Polygon'}
-            [in_features.append((code, f)) for f in src]
-
-    with fiona.open(tiles_path, 'r') as mgrs:
-        [idx.insert(i, shape(tile['geometry']).bounds) for i, tile in enumerate(mgrs)]
-        for code, f in in_features:
-            try:
-                point = shape(f['geometry']).centroid
-                for j in idx.intersection(point.coords[0]):
-                    if point.within(shape(mgrs[j]['geometry'])):
-                        tile = mgrs[j]['properties']['MGRS_TILE']
-                        if tile not in tiles:
-                            tiles.append(tile)
-                        break
-                f['properties'] = OrderedDict([('SOURCECODE', code),
-                                               ('MGRS_TILE', tile)])
-                out_features.append(f)
-            except AttributeError as e:
-                print(e)
-
-    codes = [x[1] for x in shapes]
-    for code in codes:
-        for tile in tiles:
+import numpy as np
+import shapely
+
+sys.path.append(os.path.dirname(__file__))
+from vector_io import read_layer, write_layer, concat, make_valid_polygons
+from columnar import write_side_table
+from metrics import METRICS
+
+KEY = 'SRC_KEY'
+# subdirectory of the split output holding the source attribute tables, next to the tile directories
+ATTRIBUTES = 'attributes'
+
+
+def split_by_mgrs(shapes, tiles_path, out_dir, halo=None, ext='.shp', repair=False, attributes=False):
+    """attribute source code, split into MGRS tiles, written as shapefiles or, with ext='.parquet', GeoParquet
+
+    With halo (in the units of the tile layer), each tile also receives the features of neighboring tiles that
+    fall within halo of its boundary, flagged HALO=1. They give the cleaning context across the seam and are
+    dropped from its output.
+
+    With repair, invalid geometries are fixed with make-valid, keeping their polygon parts, rather than dropped,
+    flagged REPAIRED=1 and listed in out_dir/repairs.csv.
+
+    Per-tile statistics for cost_model.py are written to out_dir/tile_stats.json.
+
+    Every feature gets SRC_KEY, a key unique across the sources, which cleaning carries in place of the source
+    attributes. It holds the source's position in shapes in the high 32 bits and the feature's index in its source
+    in the low ones, so an edit to one source leaves the keys, and so the tile files, of the others unchanged. With
+    attributes, each source's attributes are written by key to out_dir/attributes/<code>.parquet for the merge to
+    join back (see shape_ops.fiona_merge_sourcecode).
+    """
+    layers = []
+    for i, (_file, code) in enumerate(shapes):
+        layer = read_layer(_file, columns=None if attributes else [])
+        print(_file, layer.crs)
+        keys = (np.int64(i) << 32) | np.arange(len(layer), dtype=np.int64)
+        if attributes:
+            side = os.path.join(out_dir, ATTRIBUTES, '{}.parquet'.format(code))
+            write_side_table(side, OrderedDict([(KEY, keys)] + [(k, v) for k, v in layer.columns.items()
+                                                                if k != KEY]))
+        layers.append(layer.with_columns({'SOURCECODE': np.full(len(layer), code, dtype=object),
+                                          'SRC_FID': np.arange(len(layer)), KEY: keys}))
+    features = concat(layers)
+    crs = layers[-1].crs
+    METRICS.inc('features_read', len(features), stage='split')
+
+    invalid = ~shapely.is_valid(features.geometry) & ~shapely.is_missing(features.geometry)
+    repaired = np.zeros(len(features), dtype=bool)
+    if repair:
+        before = shapely.area(features.geometry)
+        features.geometry, repaired = make_valid_polygons(features.geometry)
+        lost = repaired & shapely.is_missing(features.geometry)
+        print('{} invalid geometries repaired, {} with no area left'.format(int(repaired.sum()), int(lost.sum())))
+        METRICS.inc('geometries_repaired', int(repaired.sum()), stage='split')
+        _write_repairs(os.path.join(out_dir, 'repairs.csv'), features, np.flatnonzero(repaired), before)
+
+    mgrs = read_layer(tiles_path, columns=['MGRS_TILE'])
+    tile_idx = _assign_tiles(features.geometry, mgrs.geometry)
+    unassigned = int((tile_idx < 0).sum())
+    if unassigned:
+        print('{} features without geometry or outside all tiles, skipping'.format(unassigned))
+
+    assigned = tile_idx[tile_idx >= 0]
+    first = np.unique(assigned, return_index=True)
+    tiles = first[0][np.argsort(first[1])]
+
+    halos = _halo_members(features.geometry, tile_idx, mgrs.geometry, tiles, halo) if halo else {}
+    valid = shapely.is_valid(features.geometry)
+    missing = shapely.is_missing(features.geometry)
+    codes = features['SOURCECODE']
+    _write_tile_stats(os.path.join(out_dir, 'tile_stats.json'), features.geometry, tile_idx, mgrs['MGRS_TILE'],
+                      tiles, halos, valid, invalid)
+
+    for code in [x[1] for x in shapes]:
+        for t in tiles:
+            tile = mgrs['MGRS_TILE'][t]
             dir_ = os.path.join(out_dir, tile)
             if not os.path.isdir(out_dir):
                 os.mkdir(out_dir)
@@ -47,26 +87,105 @@ def split_by_mgrs(shapes, tiles_path, out_dir):
                 os.mkdir(dir_)
             file_name = '{}_{}'.format(tile, code)
             print(dir_, file_name)
-            out_shape = os.path.join(dir_, '{}.shp'.format(file_name))
-            with fiona.open(out_shape, 'w', **meta) as output:
-                ct = 0
-                for feat in out_features:
-                    if feat['properties']['MGRS_TILE'] == tile and feat['properties']['SOURCECODE'] == code:
-                        feat = {'type': 'Feature', 'properties': OrderedDict(
-                            [('OBJECTID', ct), ('SOURCECODE', feat['properties']['SOURCECODE'])]),
-                                'geometry': feat['geometry']}
-                        if not feat['geometry']:
-                            print('None Geo, skipping')
-                        elif not shape(feat['geometry']).is_valid:
-                            print('Invalid Geo, skipping')
-                        else:
-                            output.write(feat)
-                            ct += 1
+            out_shape = os.path.join(dir_, '{}{}'.format(file_name, ext))
+
+            own = np.flatnonzero((tile_idx == t) & (codes == code))
+            ring = halos.get(t, np.array([], dtype=int))
+            ring = ring[codes[ring] == code]
+            members = np.concatenate([own, ring])
+            is_halo = np.concatenate([np.zeros(len(own), dtype=int), np.ones(len(ring), dtype=int)])
+
+            none_ct = int(missing[members].sum())
+            inval_ct = int((~valid[members] & ~missing[members]).sum())
+            if none_ct or inval_ct:
+                print('{} None Geo, {} Invalid Geo, skipping'.format(none_ct, inval_ct))
+                METRICS.inc('geometries_none', none_ct, stage='split')
+                METRICS.inc('geometries_invalid', inval_ct, stage='split')
+            keep = valid[members]
+            members, is_halo = members[keep], is_halo[keep]
+            ct, halo_ct = len(members), int(is_halo.sum())
+
             if ct == 0:
                 [os.remove(os.path.join(dir_, x)) for x in os.listdir(dir_) if file_name in x]
                 print('Not writing {}'.format(file_name))
-            else:
-                print('wrote {}, {} features'.format(out_shape, ct))
+                continue
+
+            props = OrderedDict([('OBJECTID', np.arange(ct, dtype=np.int32)), ('SOURCECODE', codes[members]),
+                                 (KEY, features[KEY][members])])
+            if halo:
+                props['HALO'] = is_halo.astype(np.int32)
+            if repair:
+                props['REPAIRED'] = repaired[members].astype(np.int32)
+            out = features.take(members).with_columns(props)
+            out.crs = crs
+            write_layer(out_shape, out, 'Polygon')
+            METRICS.inc('features_written', ct, stage='split')
+            print('wrote {}, {} features, {} halo'.format(out_shape, ct, halo_ct))
+
+
+def _write_repairs(log_file, features, repaired, area_before):
+    if not os.path.isdir(os.path.dirname(log_file)):
+        os.makedirs(os.path.dirname(log_file))
+    area_after = np.nan_to_num(shapely.area(features.geometry[repaired]))
+    parts = shapely.get_num_geometries(features.geometry[repaired])
+    with open(log_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['SOURCECODE', 'SRC_FID', 'area_before', 'area_after', 'parts'])
+        for i, after, n in zip(repaired, area_after, parts):
+            writer.writerow([features['SOURCECODE'][i], features['SRC_FID'][i], area_before[i], after, n])
+
+
+def _write_tile_stats(stats_file, geometry, tile_idx, names, tiles, halos, valid, invalid):
+    """ cheap per-tile predictors of cleaning cost: features and vertices the tile's cleaning reads, the mean
+    number of other features each of its features overlaps, and the share of its features that were invalid """
+    vertices = shapely.get_num_coordinates(geometry)
+    tree = shapely.STRtree(geometry)
+    a, b = tree.query(geometry[valid], predicate='overlaps')
+    overlaps = np.bincount(np.flatnonzero(valid)[a], minlength=len(geometry))
+
+    stats = {}
+    for t in tiles:
+        own = np.flatnonzero(tile_idx == t)
+        members = np.concatenate([own, halos.get(t, np.array([], dtype=int))])
+        members = members[valid[members]]
+        stats[str(names[t])] = {'features': int(len(members)),
+                                'halo': int(len(members) - valid[own].sum()),
+                                'vertices': int(vertices[members].sum()),
+                                'overlap_density': float(overlaps[members].mean()) if len(members) else 0.,
+                                'invalid_rate': float(invalid[own].mean()) if len(own) else 0.}
+
+    if not os.path.isdir(os.path.dirname(stats_file)):
+        os.makedirs(os.path.dirname(stats_file))
+    with open(stats_file, 'w') as f:
+        json.dump(stats, f, indent=1)
+
+
+def _assign_tiles(geometry, tile_geometry):
+    """ index of the tile containing each feature's centroid, -1 for none; the lowest index wins ties """
+    centroids = shapely.centroid(geometry)
+    tree = shapely.STRtree(tile_geometry)
+    feat, tile = tree.query(centroids, predicate='within')
+    out = np.full(len(geometry), -1, dtype=int)
+    order = np.lexsort((tile, feat))
+    feat, tile = feat[order], tile[order]
+    first = np.unique(feat, return_index=True)[1]
+    out[feat[first]] = tile[first]
+    return out
+
+
+def _halo_members(geometry, tile_idx, tile_geometry, tiles, halo):
+    """ indices of features assigned to another tile that lie within halo of each tile """
+    zones = shapely.buffer(tile_geometry[tiles], halo)
+    tree = shapely.STRtree(geometry)
+    zone, feat = tree.query(zones, predicate='intersects')
+    tile = tiles[zone]
+    keep = (tile_idx[feat] >= 0) & (tile_idx[feat] != tile)
+    zone, feat, tile = zone[keep], feat[keep], tile[keep]
+    order = np.lexsort((feat, tile))
+    members = {}
+    for t, f in zip(tile[order], feat[order]):
+        members.setdefault(t, []).append(f)
+    return {t: np.array(f, dtype=int) for t, f in members.items()}
 
 
 if __name__ == '__main__':
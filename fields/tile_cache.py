@@ -0,0 +1,86 @@
+"""
+Content-addressed store of cleaned tiles. A tile's key is a hash of the content of its ordered input files and
+their source codes, the source priority of shapefiles(state) and the CleanGeometry parameters that change its
+output, so a rerun reuses every tile whose inputs and settings are unchanged and recomputes exactly the others.
+
+Entries live in <cache_dir>/<key[:2]>/<key>/ as the output shapefile's files; content hashes of inputs are
+memoized in <cache_dir>/fingerprints.json by size and modification time (see catalog.fingerprint).
+"""
+import os
+import sys
+import json
+import shutil
+import socket
+import hashlib
+
+sys.path.append(os.path.dirname(__file__))
+from catalog import fingerprint, dataset_files
+
+
+class TileCache:
+
+    def __init__(self, cache_dir):
+        self.dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        self.memo_file = os.path.join(cache_dir, 'fingerprints.json')
+        self.memo = {}
+        if os.path.exists(self.memo_file):
+            with open(self.memo_file, 'r') as f:
+                self.memo = json.load(f)
+
+    def key(self, files, codes, priority, params):
+        """ hash of the ordered inputs' content and codes, the source priority and the cleaning parameters """
+        spec = {'inputs': [[fingerprint(f, self.memo), c] for f, c in zip(files, codes)],
+                'priority': list(priority),
+                'params': params}
+        self._save_memo()
+        return hashlib.sha1(json.dumps(spec, sort_keys=True, default=str).encode()).hexdigest()
+
+    def entry(self, key):
+        return os.path.join(self.dir, key[:2], key)
+
+    def get(self, key, out_file):
+        """ copy a cached tile to out_file, return False on a miss """
+        entry = self.entry(key)
+        if not os.path.isdir(entry):
+            return False
+        base = os.path.splitext(out_file)[0]
+        d_name = os.path.dirname(out_file)
+        if d_name and not os.path.isdir(d_name):
+            os.makedirs(d_name)
+        for f in sorted(os.listdir(entry)):
+            shutil.copyfile(os.path.join(entry, f), base + os.path.splitext(f)[1])
+        return True
+
+    def put(self, key, out_file):
+        """ store the files of out_file under key, atomically so readers never see a partial entry """
+        entry = self.entry(key)
+        if os.path.isdir(entry):
+            return entry
+        tmp = '{}.tmp{}'.format(entry, _suffix())
+        os.makedirs(tmp, exist_ok=True)
+        for f in dataset_files(out_file):
+            shutil.copyfile(f, os.path.join(tmp, 'tile' + os.path.splitext(f)[1]))
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # another worker stored the same tile first
+            shutil.rmtree(tmp, ignore_errors=True)
+        return entry
+
+    def _save_memo(self):
+        tmp = '{}.tmp{}'.format(self.memo_file, _suffix())
+        with open(tmp, 'w') as f:
+            json.dump(self.memo, f)
+        os.replace(tmp, self.memo_file)
+
+
+def _suffix():
+    # workers on different nodes share the cache directory and can share a pid
+    return '{}_{}'.format(socket.gethostname(), os.getpid())
+
+
+if __name__ == '__main__':
+    pass
+# ========================= EOF ====================================================================
@@ -0,0 +1,154 @@
+"""
+Run tiles one after another with their I/O overlapped. A reader thread fetches the next tiles' inputs from shared
+(NFS) storage to local scratch while the current tile is processed from its local copy, and a writer thread stores
+each finished output back, so reads and writes on the network run behind compute instead of between tiles. Both
+queues are bounded: at most prefetch tiles wait in scratch and at most pending_writes processed tiles wait to be
+stored, after which the side that is ahead blocks.
+
+TileRunner only orders the steps; a subclass says what fetch, process, store and finished do for an item. The
+queue worker (work_queue.py worker --scratch) runs its tile units through one, processing each in a child
+process, as CleanGeometry starts and exits QGIS and that can only happen once in a process.
+"""
+import os
+import sys
+import queue
+import shutil
+import threading
+
+parent = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(parent)
+
+from catalog import dataset_files
+from metrics import METRICS
+
+# end of a queue
+_END = None
+
+
+class TileRunner:
+
+    def __init__(self, scratch_dir, prefetch=2, pending_writes=2):
+        self.scratch = scratch_dir
+        self.prefetch = prefetch
+        self.pending_writes = pending_writes
+        # the main and writer threads both finish items
+        self.lock = threading.Lock()
+
+    def name(self, item):
+        return str(item)
+
+    def fetch(self, item, local_dir):
+        """ copy the item's inputs into local_dir, on the reader thread """
+        raise NotImplementedError
+
+    def process(self, item, local_dir, out_dir):
+        """ process the fetched inputs, writing to out_dir; returns the output to store, or None for nothing """
+        raise NotImplementedError
+
+    def store(self, item, output):
+        """ copy an output back to shared storage, on the writer thread """
+        raise NotImplementedError
+
+    def finished(self, item, error=None):
+        """ called once per item, after its output is stored or once it failed """
+        pass
+
+    def run(self, items):
+        """ process items in order as the reader thread draws them, returning the number done and failed; items
+        may be a generator, it is only advanced while fewer than prefetch fetched items wait """
+        reads = queue.Queue(maxsize=self.prefetch)
+        writes = queue.Queue(maxsize=self.pending_writes)
+        reader = threading.Thread(target=self._read, args=(items, reads), daemon=True)
+        writer = threading.Thread(target=self._write, args=(writes,), daemon=True)
+        reader.start()
+        writer.start()
+
+        self.done, self.failed = 0, 0
+        while True:
+            entry = reads.get()
+            if entry is _END:
+                break
+            item, local_split, error = entry
+            if error:
+                print('{} not processed, reading inputs failed: {}'.format(self.name(item), error))
+                self._fail(item, error)
+                continue
+
+            try:
+                output = self.process(item, local_split, self._scratch('out', item))
+            except Exception as e:
+                print('{} failed: {}'.format(self.name(item), e))
+                self._fail(item, e)
+            else:
+                # blocks while pending_writes outputs are still being stored
+                writes.put((item, output))
+            METRICS.set('tiles_prefetched', reads.qsize())
+            METRICS.set('tiles_pending_write', writes.qsize())
+
+        writes.put(_END)
+        writer.join()
+        return self.done, self.failed
+
+    def _scratch(self, kind, item):
+        return os.path.join(self.scratch, kind, self.name(item))
+
+    def _fail(self, item, error):
+        self._drop(item)
+        with self.lock:
+            self.failed += 1
+            self.finished(item, error)
+
+    def _read(self, items, reads):
+        for item in items:
+            local = self._scratch('in', item)
+            try:
+                with METRICS.timer('tile_io', op='read'):
+                    if os.path.isdir(local):
+                        shutil.rmtree(local)
+                    os.makedirs(local)
+                    self.fetch(item, local)
+                entry = (item, local, None)
+            except Exception as e:
+                entry = (item, None, e)
+            # blocks while prefetch items are already waiting
+            reads.put(entry)
+        reads.put(_END)
+
+    def _write(self, writes):
+        while True:
+            entry = writes.get()
+            if entry is _END:
+                return
+            item, output = entry
+            try:
+                if output is not None:
+                    with METRICS.timer('tile_io', op='write'):
+                        self.store(item, output)
+            except Exception as e:
+                print('{} processed, but writing it failed: {}'.format(self.name(item), e))
+                self._fail(item, e)
+                continue
+            self._drop(item)
+            with self.lock:
+                self.done += 1
+                self.finished(item)
+
+    def _drop(self, item):
+        for kind in ['in', 'out']:
+            shutil.rmtree(self._scratch(kind, item), ignore_errors=True)
+
+
+def copy_dataset(path, dst_dir):
+    """ copy the files of a dataset into dst_dir so a reader there never sees a partially copied file """
+    if not os.path.isdir(dst_dir):
+        os.makedirs(dst_dir, exist_ok=True)
+    for f in dataset_files(path):
+        target = os.path.join(dst_dir, os.path.basename(f))
+        shutil.copyfile(f, target + '.tmp')
+        os.replace(target + '.tmp', target)
+    return os.path.join(dst_dir, os.path.basename(path))
+
+
+if __name__ == '__main__':
+    pass
+# ========================= EOF ====================================================================
@@ -0,0 +1,200 @@
+"""
+Bulk vector I/O: read a whole layer, or a bbox- or attribute-filtered chunk of it, as an array of shapely
+geometries plus attribute columns, and write arrays back in one call, instead of iterating fiona feature dicts and
+calling shape() on each. OGR formats go through pyogrio, GeoParquet (see columnar.py) through pyarrow; geometry
+predicates and measures are then vectorized with shapely 2.
+"""
+import os
+import sys
+from collections import OrderedDict
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+from pyogrio import raw, read_info
+from pyproj import CRS
+
+sys.path.append(os.path.dirname(__file__))
+from columnar import GEOMETRY, is_parquet, table_crs, write_table
+
+CHUNK = 100000
+
+GEOMETRY_TYPES = {0: 'Point', 1: 'LineString', 2: 'LinearRing', 3: 'Polygon', 4: 'MultiPoint',
+                  5: 'MultiLineString', 6: 'MultiPolygon', 7: 'GeometryCollection'}
+
+
+class Layer:
+    """ geometries as a shapely array and attributes as numpy columns of the same length """
+
+    def __init__(self, geometry, columns=None, crs=None, geometry_type='Polygon'):
+        self.geometry = np.asarray(geometry, dtype=object)
+        self.columns = OrderedDict((k, np.asarray(v)) for k, v in (columns or {}).items())
+        self.crs = crs
+        self.geometry_type = geometry_type
+
+    def __len__(self):
+        return len(self.geometry)
+
+    def __getitem__(self, key):
+        return self.columns[key]
+
+    def get(self, key, default=None):
+        return self.columns.get(key, default)
+
+    def take(self, index):
+        """ a new Layer of the rows selected by a boolean mask or integer index """
+        return Layer(self.geometry[index], OrderedDict((k, v[index]) for k, v in self.columns.items()),
+                     self.crs, self.geometry_type)
+
+    def with_columns(self, columns):
+        """ a new Layer with only these columns, {name: array} """
+        return Layer(self.geometry, columns, self.crs, self.geometry_type)
+
+
+def concat(layers):
+    layers = [l for l in layers if len(l)]
+    if not layers:
+        return Layer([])
+    names = [k for k in layers[0].columns if all(k in l.columns for l in layers)]
+    return Layer(np.concatenate([l.geometry for l in layers]),
+                 OrderedDict((k, np.concatenate([l.columns[k] for l in layers])) for k in names),
+                 layers[0].crs, layers[0].geometry_type)
+
+
+def _where(filters):
+    """ OGR SQL for {column: value or list of values} """
+    clauses = []
+    for k, v in filters.items():
+        values = v if isinstance(v, (list, tuple, set)) else [v]
+        values = ', '.join("'{}'".format(x) if isinstance(x, str) else str(x) for x in values)
+        clauses.append('"{}" IN ({})'.format(k, values))
+    return ' AND '.join(clauses)
+
+
+def _filter_mask(layer, bbox=None, filters=None):
+    mask = np.ones(len(layer), dtype=bool)
+    if bbox is not None:
+        b = shapely.bounds(layer.geometry)
+        mask &= (b[:, 0] <= bbox[2]) & (b[:, 2] >= bbox[0]) & (b[:, 1] <= bbox[3]) & (b[:, 3] >= bbox[1])
+    for k, v in (filters or {}).items():
+        values = list(v) if isinstance(v, (list, tuple, set)) else [v]
+        mask &= np.isin(layer.columns[k], values)
+    return mask
+
+
+def read_layer(path, columns=None, bbox=None, filters=None, skip_features=0, max_features=None):
+    """ read a layer as a Layer; bbox (minx, miny, maxx, maxy) keeps features whose envelope intersects it and
+    filters {column: value or list of values} keeps matching features """
+    if is_parquet(path):
+        return _read_parquet(path, columns, bbox, filters, skip_features, max_features)
+
+    meta, _, wkb, field_data = raw.read(path, columns=columns, bbox=bbox,
+                                        where=_where(filters) if filters else None,
+                                        skip_features=skip_features, max_features=max_features)
+    return Layer(shapely.from_wkb(wkb), OrderedDict(zip(meta['fields'], field_data)), meta['crs'],
+                 meta['geometry_type'])
+
+
+def _read_parquet(path, columns=None, bbox=None, filters=None, skip_features=0, max_features=None):
+    names = None
+    if columns is not None:
+        names = list(columns) + [k for k in (filters or {}) if k not in columns] + [GEOMETRY]
+    table = pq.read_table(path, columns=names)
+    if skip_features or max_features is not None:
+        table = table.slice(skip_features, max_features)
+    layer = Layer(shapely.from_wkb(table.column(GEOMETRY).to_numpy(zero_copy_only=False)),
+                  OrderedDict((k, table.column(k).to_numpy(zero_copy_only=False))
+                              for k in table.column_names if k != GEOMETRY), table_crs(table))
+    if bbox is not None or filters:
+        layer = layer.take(_filter_mask(layer, bbox, filters))
+    if columns is not None:
+        layer = layer.with_columns(OrderedDict((k, layer.columns[k]) for k in columns))
+    return layer
+
+
+def iter_layer(path, chunk=CHUNK, **kwargs):
+    """ read a layer CHUNK features at a time, yielding Layers """
+    n = layer_size(path)
+    for start in range(0, n, chunk):
+        yield read_layer(path, skip_features=start, max_features=chunk, **kwargs)
+
+
+def layer_fields(path):
+    """ attribute names of a layer """
+    if is_parquet(path):
+        return [n for n in pq.ParquetFile(path).schema_arrow.names if n != GEOMETRY]
+    return list(read_info(path)['fields'])
+
+
+def layer_size(path):
+    if is_parquet(path):
+        return pq.ParquetFile(path).metadata.num_rows
+    return read_info(path)['features']
+
+
+def write_layer(path, layer, geometry_type=None):
+    """ write a Layer in one call, as GeoParquet for .parquet paths and with the OGR driver for the extension
+    otherwise """
+    geometry_type = geometry_type if geometry_type else layer.geometry_type
+    if is_parquet(path):
+        cols = OrderedDict((k, pa.array(v)) for k, v in layer.columns.items())
+        cols[GEOMETRY] = pa.array(shapely.to_wkb(layer.geometry), type=pa.binary())
+        types = [GEOMETRY_TYPES[t] for t in np.unique(shapely.get_type_id(layer.geometry)) if t >= 0]
+        return write_table(path, pa.table(cols), _crs_wkt(layer.crs), types)
+
+    raw.write(path, shapely.to_wkb(layer.geometry), list(layer.columns.values()), list(layer.columns),
+              geometry_type=geometry_type, crs=layer.crs, promote_to_multi=False)
+    return path
+
+
+def convert(in_path, out_path):
+    """ shapefile to GeoParquet or back, by the output extension """
+    return write_layer(out_path, read_layer(in_path))
+
+
+def _crs_wkt(crs):
+    return CRS.from_user_input(crs).to_wkt() if crs else None
+
+
+def polygon_parts(geometry):
+    """ explode an array of (multi)polygons and collections to single polygons, with the index of the geometry
+    each part came from """
+    parts, index = shapely.get_parts(geometry, return_index=True)
+    # a make-valid collection can hold multi-part members, explode those too
+    parts, nested = shapely.get_parts(parts, return_index=True)
+    index = index[nested]
+    keep = shapely.get_type_id(parts) == 3
+    return parts[keep], index[keep]
+
+
+def make_valid_polygons(geometry):
+    """ repair invalid geometries with make-valid, keeping only the polygon parts with area
+
+    Returns the geometry array with invalid members replaced by a Polygon, a MultiPolygon or None where no area
+    is left, and a boolean array of which members were repaired.
+    """
+    geometry = np.array(geometry, dtype=object)
+    repaired = ~shapely.is_valid(geometry) & ~shapely.is_missing(geometry)
+    if not repaired.any():
+        return geometry, repaired
+
+    fixed = shapely.make_valid(geometry[repaired])
+    parts, part_of = polygon_parts(fixed)
+    keep = shapely.area(parts) > 0.0
+    parts, part_of = parts[keep], part_of[keep]
+
+    out = np.full(len(fixed), None, dtype=object)
+    counts = np.bincount(part_of, minlength=len(fixed))
+    single = counts[part_of] == 1
+    out[part_of[single]] = parts[single]
+    multi = np.flatnonzero(counts > 1)
+    if len(multi):
+        out[multi] = shapely.multipolygons(parts[~single], indices=np.searchsorted(multi, part_of[~single]))
+    geometry[repaired] = out
+    return geometry, repaired
+
+
+if __name__ == '__main__':
+    pass
+# ========================= EOF ====================================================================
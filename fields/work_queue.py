@@ -0,0 +1,471 @@
+"""
+File-based work queue for running many states over many nodes, needing nothing but a shared filesystem.
+
+Units are small JSON files moved between pending/, claimed/, done/ and failed/ under the queue directory. A worker
+claims a unit with an atomic rename, keeps the claimed file's mtime fresh from a heartbeat thread while it works,
+and renames it to done/ or failed/. Claimed units whose heartbeat stops are returned to pending/ by any idle
+worker. Units are (state, tile) tile runs, preceded by one split and followed by one merge per state:
+
+    python work_queue.py expand /shared/queue MT ID --tiles /shared/MGRS_TILE.shp --work-root /shared/work
+    python work_queue.py worker /shared/queue      # on as many nodes, as many times, as wanted
+    python work_queue.py status /shared/queue
+
+With --scratch, a worker runs tile units from local scratch through a TileRunner (tile_runner.py): it claims and
+fetches the next tiles' split files while the current tile runs, and stores each geographic output back and
+finishes its unit in the background.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import threading
+
+import click
+
+parent = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(parent)
+
+from catalog import SourceCatalog
+from metrics import METRICS, Progress
+from cost_model import plan_for
+from pipeline import (Pipeline, pipeline_dirs, tile_tasks, split_task, merge_task, split_tiles, attributes_dir)
+from tile_runner import TileRunner, copy_dataset
+
+STATES = ['pending', 'claimed', 'done', 'failed']
+KIND_ORDER = {'split': 0, 'tile': 1, 'merge': 2}
+
+
+class WorkQueue:
+
+    def __init__(self, queue_dir, heartbeat=30., timeout=600., max_attempts=3):
+        self.dir = queue_dir
+        self.heartbeat = heartbeat
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        for s in STATES:
+            d = os.path.join(queue_dir, s)
+            if not os.path.isdir(d):
+                os.makedirs(d, exist_ok=True)
+
+    @property
+    def config(self):
+        with open(os.path.join(self.dir, 'config.json'), 'r') as f:
+            return json.load(f)
+
+    def write_config(self, config):
+        tmp = os.path.join(self.dir, 'config.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(config, f, indent=1)
+        os.replace(tmp, os.path.join(self.dir, 'config.json'))
+
+    def path(self, state, unit_id):
+        return os.path.join(self.dir, state, '{}.json'.format(unit_id))
+
+    def units(self, state):
+        return sorted(f[:-5] for f in os.listdir(os.path.join(self.dir, state)) if f.endswith('.json'))
+
+    def put(self, unit):
+        """ add a unit to pending unless it is already somewhere in the queue """
+        uid = unit_id(unit)
+        if any(os.path.exists(self.path(s, uid)) for s in STATES):
+            return False
+        try:
+            with open(self.path('pending', uid), 'x') as f:
+                json.dump(unit, f)
+        except FileExistsError:
+            return False
+        return True
+
+    def ready(self, uid):
+        kind, state = uid.split('_')[:2]
+        if kind == 'tile':
+            return os.path.exists(self.path('done', 'split_{}'.format(state)))
+        if kind == 'merge':
+            prefix = 'tile_{}_'.format(state)
+            busy = [u for s in ['pending', 'claimed'] for u in self.units(s) if u.startswith(prefix)]
+            return not busy and os.path.exists(self.path('done', 'split_{}'.format(state)))
+        return True
+
+    def claim(self, worker, priority=None, kinds=None):
+        """ move the first ready pending unit, of one of kinds if given, to claimed/, return it or None;
+        priority(uid), if given, orders units of the same kind, highest first """
+        priority = priority if priority else (lambda u: 0.)
+        pending = sorted(self.units('pending'), key=lambda u: (KIND_ORDER[u.split('_')[0]], -priority(u), u))
+        for uid in pending:
+            if kinds and uid.split('_')[0] not in kinds:
+                continue
+            if not self.ready(uid):
+                continue
+            src, dst = self.path('pending', uid), self.path('claimed', uid)
+            try:
+                # refresh mtime before the rename so the claim never looks stale
+                os.utime(src)
+                os.rename(src, dst)
+            except FileNotFoundError:
+                continue
+            with open(dst, 'r') as f:
+                unit = json.load(f)
+            unit['worker'] = worker
+            unit['claimed'] = time.time()
+            unit['attempts'] = unit.get('attempts', 0) + 1
+            with open(dst, 'w') as f:
+                json.dump(unit, f)
+            return unit
+        return None
+
+    def owns(self, unit):
+        """ whether the unit's claim is still the one this worker made, not recovered or claimed again since """
+        try:
+            with open(self.path('claimed', unit_id(unit)), 'r') as f:
+                claim = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return False
+        return claim.get('worker') == unit['worker'] and claim.get('claimed') == unit['claimed']
+
+    def finish(self, unit, state, error=None):
+        """ move a unit this worker still owns to done/ or failed/ and record its result there """
+        uid = unit_id(unit)
+        if not self.owns(unit):
+            print('{} was recovered from this worker, result not recorded'.format(uid))
+            return False
+        if error:
+            unit['error'] = error
+        unit['finished'] = time.time()
+        dst = self.path(state, uid)
+        try:
+            # rename, never rewrite, the claim, so a claim recovered meanwhile is not brought back
+            os.rename(self.path('claimed', uid), dst)
+        except FileNotFoundError:
+            print('{} was recovered from this worker, result not recorded'.format(uid))
+            return False
+        tmp = dst + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(unit, f)
+        os.replace(tmp, dst)
+        return True
+
+    def recover(self):
+        """ return claimed units whose heartbeat is older than timeout to pending, or fail them after
+        max_attempts """
+        now = time.time()
+        for uid in self.units('claimed'):
+            path = self.path('claimed', uid)
+            try:
+                if now - os.path.getmtime(path) < self.timeout:
+                    continue
+                with open(path, 'r') as f:
+                    unit = json.load(f)
+                dst = 'failed' if unit.get('attempts', 0) >= self.max_attempts else 'pending'
+                os.rename(path, self.path(dst, uid))
+                print('recovered {} from {} to {}'.format(uid, unit.get('worker'), dst))
+            except (FileNotFoundError, ValueError):
+                continue
+
+    def status(self):
+        return {s: len(self.units(s)) for s in STATES}
+
+
+def unit_id(unit):
+    if unit['kind'] == 'tile':
+        return 'tile_{}_{}'.format(unit['state'], unit['tile'])
+    return '{}_{}'.format(unit['kind'], unit['state'])
+
+
+class Heartbeat(threading.Thread):
+    """ keep a claim's mtime fresh while this worker owns it, stopping once it was recovered or claimed by
+    another worker """
+
+    def __init__(self, queue, unit):
+        super(Heartbeat, self).__init__(daemon=True)
+        self.queue = queue
+        self.unit = unit
+        self.path = queue.path('claimed', unit_id(unit))
+        self.interval = queue.heartbeat
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if not self.queue.owns(self.unit):
+                print('lost the claim on {}'.format(unit_id(self.unit)))
+                return
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                return
+
+    def stop(self):
+        self.stopped.set()
+
+
+def expand(queue, states, tiles_path, work_root, cdl=None, halo=None, root=None, ext='.shp', repair=False,
+           cost_model=None, risk=0.5, cache_dir=None, attributes=False, clean_kwargs=None):
+    """ write the run configuration and queue split, tile and merge units for each state from the catalog;
+    clean_kwargs are passed to CleanGeometry for every tile, as with the pipeline """
+    queue.write_config({'tiles_path': tiles_path, 'work_root': work_root, 'cdl': cdl, 'halo': halo, 'root': root,
+                        'ext': ext, 'repair': repair, 'cost_model': cost_model, 'risk': risk,
+                        'cache_dir': cache_dir, 'attributes': attributes, 'clean_kwargs': clean_kwargs or {}})
+    catalog = SourceCatalog(root)
+    for state in states:
+        tiles = catalog.tiles_for(state, tiles_path)
+        est = catalog.estimate(state)
+        added = queue.put({'kind': 'split', 'state': state})
+        added += sum(queue.put({'kind': 'tile', 'state': state, 'tile': t}) for t in tiles)
+        added += queue.put({'kind': 'merge', 'state': state})
+        print('{}: {} tiles, {} features, {} vertices, {} units queued'.format(state, len(tiles), est['features'],
+                                                                               est['vertices'], added))
+
+
+def state_plan(state, config):
+    """ cost model predictions for a state's tiles once its split has written tile statistics """
+    stats = os.path.join(pipeline_dirs(os.path.join(config['work_root'], state))['split'], 'tile_stats.json')
+    return plan_for(stats, config.get('cost_model'), config.get('risk', 0.5))
+
+
+def unit_dirs(state, config):
+    dirs = pipeline_dirs(os.path.join(config['work_root'], state))
+    if config.get('cache_dir'):
+        dirs['clean_cache'] = config['cache_dir']
+    return dirs
+
+
+def unit_tile_tasks(unit, config, dirs):
+    """ the zonal, projection, cleaning and back-projection tasks of a tile unit, reading the split from and
+    writing to dirs """
+    plan = state_plan(unit['state'], config).get(unit['tile'])
+    return tile_tasks(unit['state'], unit['tile'], dirs, config['cdl'], config.get('clean_kwargs'),
+                      ext=config.get('ext', '.shp'), plan=plan)
+
+
+def run_unit(unit, config):
+    state = unit['state']
+    work_dir = os.path.join(config['work_root'], state)
+    dirs = unit_dirs(state, config)
+    ext = config.get('ext', '.shp')
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir, exist_ok=True)
+
+    if unit['kind'] == 'split':
+        pipe = Pipeline(os.path.join(work_dir, 'split_state.json'))
+        pipe.add(split_task(state, config['tiles_path'], dirs, config['halo'], config['root'], ext=ext,
+                            repair=config.get('repair', False), attributes=config.get('attributes', False)))
+
+    elif unit['kind'] == 'tile':
+        if unit['tile'] not in split_tiles(dirs):
+            print('no fields in {} {}'.format(state, unit['tile']))
+            return
+        pipe = Pipeline(os.path.join(work_dir, 'tiles', '{}.json'.format(unit['tile'])))
+        for t in unit_tile_tasks(unit, config, dirs):
+            pipe.add(t)
+
+    else:
+        tiles = split_tiles(dirs)
+        geographic = [os.path.join(dirs['cleaned'], '{}{}'.format(t, ext)) for t in tiles]
+        # a failed tile unit leaves no output; merging without it would silently drop its fields
+        missing = [t for t, g in zip(tiles, geographic) if not os.path.exists(g)]
+        if missing:
+            raise RuntimeError('{} of {} tiles not cleaned for {}: {}'.format(len(missing), len(tiles), state,
+                                                                             ', '.join(missing)))
+        if not geographic:
+            raise RuntimeError('no cleaned tiles to merge for {}'.format(state))
+        pipe = Pipeline(os.path.join(work_dir, 'merge_state.json'))
+        pipe.add(merge_task(state, os.path.join(work_dir, '{}_fields{}'.format(state, ext)), geographic,
+                            config['halo'], attributes_dir=attributes_dir(dirs, config.get('attributes', False))))
+
+    d_name = os.path.dirname(pipe.state_file)
+    if not os.path.isdir(d_name):
+        os.makedirs(d_name, exist_ok=True)
+    failed = pipe.run(1)
+    if failed:
+        raise RuntimeError('failed tasks: {}'.format(', '.join(sorted(failed))))
+
+
+class QueueTileRunner(TileRunner):
+    """ tile units claimed from the queue and run from local scratch: a tile's split files are fetched, its tasks
+    run there, each in a child process as in run_unit, and its geographic output is stored to the shared cleaned
+    directory before the unit is finished """
+
+    def __init__(self, queue, config, worker, scratch_dir, prefetch=2, pending_writes=2):
+        super(QueueTileRunner, self).__init__(scratch_dir, prefetch, pending_writes)
+        self.queue = queue
+        self.config = config
+        self.worker = worker
+        self.beats = {}
+
+    def name(self, unit):
+        return unit_id(unit)
+
+    def units(self, priority=None):
+        """ claim ready tile units one at a time, as the reader thread asks for them """
+        while True:
+            unit = self.queue.claim(self.worker, priority, kinds=['tile'])
+            if unit is None:
+                return
+            print('{} running {}'.format(self.worker, unit_id(unit)))
+            beat = Heartbeat(self.queue, unit)
+            beat.start()
+            self.beats[unit_id(unit)] = beat
+            yield unit
+
+    def fetch(self, unit, local_dir):
+        src = os.path.join(unit_dirs(unit['state'], self.config)['split'], unit['tile'])
+        if not os.path.isdir(src):
+            return
+        dst = os.path.join(local_dir, unit['tile'])
+        os.makedirs(dst)
+        for f in sorted(os.listdir(src)):
+            if os.path.isfile(os.path.join(src, f)):
+                shutil.copy2(os.path.join(src, f), os.path.join(dst, f))
+
+    def process(self, unit, local_dir, out_dir):
+        shared = unit_dirs(unit['state'], self.config)
+        if unit['tile'] not in split_tiles(shared):
+            print('no fields in {} {}'.format(unit['state'], unit['tile']))
+            return None
+        # intermediates stay in scratch; profiles and the tile cache are shared
+        dirs = dict(pipeline_dirs(out_dir), split=local_dir, profiles=shared['profiles'],
+                    clean_cache=shared['clean_cache'])
+        pipe = Pipeline(os.path.join(out_dir, 'tile_state.json'))
+        for t in unit_tile_tasks(unit, self.config, dirs):
+            pipe.add(t)
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        failed = pipe.run(1)
+        if failed:
+            raise RuntimeError('failed tasks: {}'.format(', '.join(sorted(failed))))
+        return os.path.join(dirs['cleaned'], '{}{}'.format(unit['tile'], self.config.get('ext', '.shp')))
+
+    def store(self, unit, output):
+        copy_dataset(output, unit_dirs(unit['state'], self.config)['cleaned'])
+
+    def finished(self, unit, error=None):
+        self.beats.pop(unit_id(unit)).stop()
+        if error:
+            self.queue.finish(unit, 'failed', str(error))
+        else:
+            self.queue.finish(unit, 'done')
+        METRICS.inc('units', kind='tile', status='failed' if error else 'ok')
+
+
+def work(queue, worker=None, poll=30., scratch=None, prefetch=2, pending_writes=2):
+    """ claim and run units until the queue has nothing pending or claimed; with scratch, tile units run
+    through a QueueTileRunner """
+    worker = worker if worker else '{}:{}'.format(socket.gethostname(), os.getpid())
+    config = queue.config
+    status = queue.status()
+    progress = Progress('units', sum(status.values()))
+    plans = {}
+    runner = QueueTileRunner(queue, config, worker, scratch, prefetch, pending_writes) if scratch else None
+
+    def priority(uid):
+        # longest predicted tiles first, from each state's plan once its split is done
+        kind, state = uid.split('_')[:2]
+        if kind != 'tile':
+            return 0.
+        if not plans.get(state):
+            plans[state] = state_plan(state, config)
+        return plans[state].get(uid.split('_', 2)[2], (0.,))[0]
+
+    while True:
+        status = queue.status()
+        progress.update(status['done'], status['failed'], sum(status.values()))
+        if runner and sum(runner.run(runner.units(priority))):
+            continue
+        unit = queue.claim(worker, priority)
+        if unit is None:
+            queue.recover()
+            status = queue.status()
+            if not status['claimed']:
+                # nothing is running that could make a pending unit ready
+                print('{} nothing left to run, {}'.format(worker, status))
+                return
+            time.sleep(poll)
+            continue
+
+        uid = unit_id(unit)
+        print('{} running {}'.format(worker, uid))
+        beat = Heartbeat(queue, unit)
+        beat.start()
+        try:
+            run_unit(unit, config)
+        except Exception as e:
+            print('{} {} failed: {}'.format(worker, uid, e))
+            beat.stop()
+            queue.finish(unit, 'failed', str(e))
+            METRICS.inc('units', kind=unit['kind'], status='failed')
+        else:
+            beat.stop()
+            queue.finish(unit, 'done')
+            METRICS.inc('units', kind=unit['kind'], status='ok')
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command('expand')
+@click.argument('queue_dir')
+@click.argument('states', nargs=-1)
+@click.option('--tiles', 'tiles_path', required=True, help='MGRS tile shapefile')
+@click.option('--work-root', required=True, help='shared directory for per-state pipeline outputs')
+@click.option('--cdl', default=None, help='CDL raster for the zonal crop filter')
+@click.option('--halo', default=None, type=float, help='halo distance for split tiles')
+@click.option('--root', default=None, help='data root for the source catalog')
+@click.option('--format', 'fmt', default='shp', type=click.Choice(['shp', 'parquet']),
+              help='format of split, filtered, geographic and merged files')
+@click.option('--repair', is_flag=True, help='repair invalid geometries in the split instead of dropping them')
+@click.option('--cost-model', default=None, help='model from cost_model.py fit, to order tiles and pick v_clean')
+@click.option('--risk', default=0.5, help='predicted failure risk above which a tile is cleaned with v_clean')
+@click.option('--cache-dir', default=None, help='cleaned tile cache shared by all workers')
+@click.option('--attributes', is_flag=True, help='join the source attributes of each field onto the merged output')
+@click.option('--precision', default=None, type=float,
+              help='fixed-precision grid for cleaning overlays in projected units, e.g. 0.01 for 1 cm')
+@click.option('--memory-budget', default=None, type=float,
+              help='megabytes of geometry above which cleaning keeps intermediate layers on disk')
+@click.option('--profile-vertices', is_flag=True,
+              help='add vertex counts to the stage profiles, at the cost of a pass over each layer per stage')
+def expand_cmd(queue_dir, states, tiles_path, work_root, cdl, halo, root, fmt, repair, cost_model, risk, cache_dir,
+               attributes, precision, memory_budget, profile_vertices):
+    clean_kwargs = {k: v for k, v in [('precision', precision), ('memory_budget', memory_budget),
+                                      ('profile_vertices', profile_vertices)] if v}
+    expand(WorkQueue(queue_dir), states, tiles_path, work_root, cdl, halo, root, '.{}'.format(fmt), repair,
+           cost_model, risk, cache_dir, attributes, clean_kwargs)
+
+
+@cli.command('worker')
+@click.argument('queue_dir')
+@click.option('--worker-id', default=None, help='defaults to host:pid')
+@click.option('--heartbeat', default=30., help='seconds between heartbeats')
+@click.option('--timeout', default=600., help='seconds without a heartbeat before a unit is recovered')
+@click.option('--metrics-dir', default=None, help='directory for Prometheus textfile metrics')
+@click.option('--scratch', default=None, help='local directory to run tile units in, with their I/O overlapped')
+@click.option('--prefetch', default=2, help='tile units claimed and read ahead into scratch')
+@click.option('--pending-writes', default=2, help='finished tile units that may wait to be written back')
+def worker_cmd(queue_dir, worker_id, heartbeat, timeout, metrics_dir, scratch, prefetch, pending_writes):
+    METRICS.configure(metrics_dir)
+    work(WorkQueue(queue_dir, heartbeat, timeout), worker_id, scratch=scratch, prefetch=prefetch,
+         pending_writes=pending_writes)
+
+
+@cli.command('status')
+@click.argument('queue_dir')
+def status_cmd(queue_dir):
+    queue = WorkQueue(queue_dir)
+    print(queue.status())
+    for uid in queue.units('failed'):
+        with open(queue.path('failed', uid), 'r') as f:
+            print(uid, json.load(f).get('error'))
+
+
+@cli.command('recover')
+@click.argument('queue_dir')
+@click.option('--timeout', default=600., help='seconds without a heartbeat before a unit is recovered')
+def recover_cmd(queue_dir, timeout):
+    WorkQueue(queue_dir, timeout=timeout).recover()
+
+
+if __name__ == '__main__':
+    cli()
+# ========================= EOF ====================================================================
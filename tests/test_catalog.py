@@ -0,0 +1,38 @@
+import os
+import sys
+
+import shapely
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fields'))
+from catalog import fingerprint
+from vector_io import Layer, write_layer
+
+
+def _write(path, codes):
+    geometry = [shapely.box(i, 0, i + 1, 1) for i in range(len(codes))]
+    write_layer(path, Layer(geometry, {'SOURCECODE': codes}, 'EPSG:4326'))
+    return path
+
+
+def _set_dbf_date(path, year, month, day):
+    with open(path[:-4] + '.dbf', 'r+b') as f:
+        f.seek(1)
+        f.write(bytes([year - 1900, month, day]))
+
+
+def test_fingerprint_ignores_dbf_write_date(tmp_path):
+    path = str(tmp_path / 'fields.shp')
+    _write(path, ['A', 'B'])
+    _set_dbf_date(path, 2024, 1, 2)
+    first = fingerprint(path)
+
+    # the same data written again on another day
+    _write(path, ['A', 'B'])
+    _set_dbf_date(path, 2024, 3, 4)
+    assert fingerprint(path) == first
+
+
+def test_fingerprint_follows_attributes(tmp_path):
+    path = str(tmp_path / 'fields.shp')
+    first = fingerprint(_write(path, ['A', 'B']))
+    assert fingerprint(_write(path, ['A', 'C'])) != first
@@ -0,0 +1,41 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fields'))
+from tile_runner import TileRunner
+
+
+class _Runner(TileRunner):
+
+    def __init__(self, scratch_dir):
+        super(_Runner, self).__init__(scratch_dir, prefetch=1, pending_writes=1)
+        self.stored, self.results = [], {}
+
+    def fetch(self, item, local_dir):
+        if item == 'unreadable':
+            raise IOError('no inputs')
+        with open(os.path.join(local_dir, 'in.txt'), 'w') as f:
+            f.write(item)
+
+    def process(self, item, local_dir, out_dir):
+        if item == 'broken':
+            raise RuntimeError('failed')
+        with open(os.path.join(local_dir, 'in.txt'), 'r') as f:
+            return f.read().upper()
+
+    def store(self, item, output):
+        self.stored.append(output)
+
+    def finished(self, item, error=None):
+        self.results[item] = error is None
+
+
+def test_runner_stores_in_order_and_finishes_every_item(tmp_path):
+    runner = _Runner(str(tmp_path))
+    done, failed = runner.run(iter(['a', 'unreadable', 'b', 'broken', 'c']))
+
+    assert (done, failed) == (3, 2)
+    assert runner.stored == ['A', 'B', 'C']
+    assert runner.results == {'a': True, 'unreadable': False, 'b': True, 'broken': False, 'c': True}
+    # scratch copies are dropped once an item is finished
+    assert os.listdir(os.path.join(str(tmp_path), 'in')) == []
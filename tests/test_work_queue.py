@@ -0,0 +1,31 @@
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fields'))
+from work_queue import WorkQueue
+
+
+def test_finish_after_recover_leaves_unit_pending(tmp_path):
+    queue = WorkQueue(str(tmp_path), timeout=0.)
+    queue.put({'kind': 'split', 'state': 'MT'})
+    unit = queue.claim('w1')
+    time.sleep(0.01)
+    queue.recover()
+
+    assert not queue.finish(unit, 'done')
+    assert queue.status() == {'pending': 1, 'claimed': 0, 'done': 0, 'failed': 0}
+
+
+def test_finish_leaves_another_workers_claim(tmp_path):
+    queue = WorkQueue(str(tmp_path), timeout=0.)
+    queue.put({'kind': 'split', 'state': 'MT'})
+    unit = queue.claim('w1')
+    time.sleep(0.01)
+    queue.recover()
+    other = queue.claim('w2')
+
+    assert not queue.finish(unit, 'failed', 'lost')
+    assert queue.status()['claimed'] == 1
+    assert queue.finish(other, 'done')
+    assert queue.status() == {'pending': 0, 'claimed': 0, 'done': 1, 'failed': 0}